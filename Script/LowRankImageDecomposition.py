@@ -6,15 +6,33 @@ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
 import SimpleITK as sitk
+import numpy
 import pyLAR
 from distutils.spawn import find_executable
 import json
 import threading
 import Queue
-from time import sleep
+from time import sleep, time
 import errno
 import re
 import hashlib
+import collections
+import glob
+import multiprocessing
+import subprocess
+import tarfile
+import tempfile
+from multiprocessing.pool import ThreadPool
+from LowRankImageDecompositionStorage import (UncompressedCache, PreprocessingCache, RunCache, ResultStore,
+                                              MirrorSelector, DatasetRegistry)
+try:
+    import psutil
+except ImportError:
+    psutil = None
+try:
+    import threadpoolctl
+except ImportError:
+    threadpoolctl = None
 
 #
 # Low-rank Image Decomposition
@@ -53,6 +71,7 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
     class QMovingProgressBar(qt.QProgressBar):
         def __init__(self, size=15, interval=100):
             qt.QProgressBar.__init__(self)
+            self.steps = size
             self.setRange(0, size)
             self.timer = qt.QTimer()
             self.timer.setInterval(interval)
@@ -60,10 +79,31 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
             self.setTextVisible(False)
 
         def start(self):
+            self.setRange(0, self.steps)
+            self.setTextVisible(False)
             self.setValue(0)
             self.show()
             self.timer.start()
 
+        def setBusy(self, text):
+            """ Animates the bar (the amount of work is unknown) and displays the given text.
+            """
+            if not self.timer.isActive() or self.maximum != self.steps:
+                self.setRange(0, self.steps)
+                self.setValue(0)
+                self.timer.start()
+            self.setFormat(text)
+            self.setTextVisible(True)
+
+        def setProgress(self, fraction, text):
+            """ Stops the animation and displays the given fraction (between 0 and 1) and text.
+            """
+            self.timer.stop()
+            self.setRange(0, 1000)
+            self.setValue(int(min(max(fraction, 0.0), 1.0) * 1000))
+            self.setFormat(text)
+            self.setTextVisible(True)
+
         def _move(self):
             self.value += 1
             if self.value == self.maximum:
@@ -87,6 +127,11 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
                           "Low Rank/Sparse Decomposition": "lr",
                           "Low Rank Atlas Creation": "nglra"}
         self.errorLog = slicer.app.errorLogModel()
+        # New log entries are displayed at most 4 times per second
+        self.logCursor = ErrorLogCursor(self.errorLog, capacity=500)
+        self.logTimer = qt.QTimer()
+        self.logTimer.setInterval(250)
+        self.logTimer.connect('timeout()', self.flushLog)
 
         # Instantiate and connect widgets ...
 
@@ -212,9 +257,30 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
         # Layout within a collapsible button
         outputFormLayout = qt.QFormLayout(outputCollapsibleButton)
 
+        # Load volumes on demand
+        self.lazyLoadingCheckBox = qt.QCheckBox("Load volumes only when displayed")
+        self.lazyLoadingCheckBox.toolTip = "Add downloaded and computed volumes to the scene without loading them. " \
+                                           "Volumes are loaded when displayed, and the least recently displayed " \
+                                           "volumes are unloaded when the memory limit is reached."
+        outputFormLayout.addRow(self.lazyLoadingCheckBox)
+        self.memoryLimitSpinBox = qt.QSpinBox()
+        self.memoryLimitSpinBox.setRange(100, 1000000)
+        self.memoryLimitSpinBox.setSingleStep(512)
+        self.memoryLimitSpinBox.suffix = " MB"
+        self.memoryLimitSpinBox.value = 2048
+        self.memoryLimitSpinBox.toolTip = "Maximum memory used by volumes loaded on demand."
+        outputFormLayout.addRow("Memory limit: ", self.memoryLimitSpinBox)
+
+        # Profiling
+        self.profilingCheckBox = qt.QCheckBox("Profile processing")
+        self.profilingCheckBox.toolTip = "Profile the processing thread and save the profile and a summary of " \
+                                         "the slowest functions and external tools in the output directory."
+        outputFormLayout.addRow(self.profilingCheckBox)
+
         # show log
         self.log = qt.QTextEdit()
         self.log.readOnly = True
+        self.log.document().setMaximumBlockCount(self.logCursor.capacity)
 
         outputFormLayout.addRow(self.log)
         self.logMessage('<p>Status: <i>Idle</i>\n')
@@ -230,6 +296,9 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
 
         # connections
         self.applyButton.connect('clicked(bool)', self.onApplyButton)
+        self.lazyLoadingCheckBox.connect('toggled(bool)', self.onLazyLoadingChanged)
+        self.memoryLimitSpinBox.connect('valueChanged(int)', self.onLazyLoadingChanged)
+        self.profilingCheckBox.connect('toggled(bool)', self.onProfilingChanged)
         self.selectConfigFileButton.connect('clicked(bool)', self.onSelectFile)
         self.selectUnbiasedAtlas.connect('clicked(bool)', self.onSelect)
         self.selectLowRankDecomposition.connect('clicked(bool)', self.onSelect)
@@ -284,8 +353,20 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
             logging.info("Download will stop after current file.")
             self.logic.abort = True
 
-    def logEvent(self):
-        self.logMessage(self.errorLog.logEntryDescription(self.errorLog.logEntryCount() - 1))
+    def onLazyLoadingChanged(self):
+        self.logic.setLazyLoading(self.lazyLoadingCheckBox.checked, self.memoryLimitSpinBox.value)
+
+    def onProfilingChanged(self):
+        self.logic.profiling = self.profilingCheckBox.checked
+
+    def flushLog(self):
+        """ Appends the log entries added since the last call, if any.
+        """
+        lines = self.logCursor.drain()
+        if lines is not None:
+            self.log.moveCursor(qt.QTextCursor.End)
+            self.log.insertPlainText(('\n' if self.log.document().characterCount() > 1 else '') + '\n'.join(lines))
+            self.log.ensureCursorVisible()
 
     def logMessage(self, message):
         self.log.setText(str(message))
@@ -308,19 +389,22 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
             self.logic.createExampleConfigurationAndListFiles(file, self.BullseyeFileName, algo)
         qt.QMessageBox.warning(slicer.util.mainWindow(),
                                'Download data',
-                               'To use this configuration file, you will need to download the synthetic data')
+                               'The synthetic data used by this configuration file will be downloaded when it is run')
 
     def initProcessGUI(self):
         self.progress_bar.start()
         sa = slicer.util.findChildren(name='ScrollArea')[0]
         vs = sa.verticalScrollBar()
         vs.setSliderPosition(vs.maximum)
-        self.errorLog.connect('entryAdded(ctkErrorLogLevel::LogLevel)', self.logEvent)
+        self.log.clear()
+        self.logCursor.start()
+        self.logTimer.start()
 
     def cleanup(self):
         self.resetUI()
         if self.logic:
             self.logic.abort = True
+            self.logic.setLazyLoading(False)
         self.configFile = None
         self.selectedConfigFile.text = ''
 
@@ -329,7 +413,8 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
         self.applyButton.enabled = self.configFile and self.selectAlgorithm.checkedButton()
 
     def resetUI(self):
-        self.errorLog.disconnect('entryAdded(ctkErrorLogLevel::LogLevel)', self.logEvent)
+        self.logTimer.stop()
+        self.flushLog()
         self.progress_bar.clear()
 
     def onApplyButton(self):
@@ -343,12 +428,913 @@ class LowRankImageDecompositionWidget(ScriptedLoadableModuleWidget):
             # if error, stop logic
             self.onLogicRunStop()
 
+    def onProgress(self, progress):
+        """ Displays progress reported by the logic (see 'ProgressTracker.snapshot()').
+
+        The progress bar keeps moving as long as the total amount of work is unknown.
+        """
+        if progress['fraction'] is None:
+            text = progress['label']
+        else:
+            text = '%s: %d%%' % (progress['label'], int(progress['fraction'] * 100))
+            if progress['eta'] is not None:
+                text += ' - %s left' % self.formatDuration(progress['eta'])
+        if progress['detail']:
+            text += ' (%s)' % progress['detail']
+        if progress['fraction'] is None:
+            self.progress_bar.setBusy(text)
+        else:
+            self.progress_bar.setProgress(progress['fraction'], text)
+
+    def formatDuration(self, seconds):
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return '%dh%02dm' % (hours, minutes)
+        return '%dm%02ds' % (minutes, seconds)
+
     def onLogicRunStop(self):
         """ Reset UI once logic is done"""
         self.resetUI()
         self.logic.post_queue_stop_delayed()
 
 
+#
+# ErrorLogCursor
+#
+
+class ErrorLogCursor(object):
+    """
+  Read position in a log model (e.g. 'slicer.app.errorLogModel()'), returning the entries added since the
+  last call to 'drain()'.
+
+  The model receives the messages of all the loggers, of the external tools and of Slicer itself, and keeps
+  them: the cursor only stores the index of the next entry to read. At most the last 'capacity' new entries
+  are returned, so the GUI can periodically append them to its log view instead of being updated for every
+  entry.
+  """
+
+    def __init__(self, model, capacity=500):
+        self.model = model
+        self.capacity = capacity
+        self.index = 0
+
+    def start(self):
+        """ Ignores the entries added before this call.
+        """
+        self.index = self.model.logEntryCount()
+
+    def drain(self):
+        """ Returns the descriptions of the entries added since the last call, or None if there is none.
+        """
+        count = self.model.logEntryCount()
+        if count < self.index:
+            # The model was cleared
+            self.index = 0
+        first = max(self.index, count - self.capacity)
+        self.index = count
+        if first >= count:
+            return None
+        return [self.model.logEntryDescription(i) for i in range(first, count)]
+
+
+#
+# ProgressTracker
+#
+
+class ProgressTracker(object):
+    """
+  Thread-safe progress state shared between a processing thread and Slicer's main thread.
+
+  Processing threads report progress with 'begin()', 'update()' and 'advance()'. Reports are
+  coalesced: 'callback' is called at most once every 'min_interval' seconds (and every time a
+  task begins or is complete), so that the GUI is not redrawn for every event.
+  """
+
+    def __init__(self, callback=None, min_interval=0.25):
+        self.callback = None
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_notification = 0
+        self.begin('', 0)
+        self.callback = callback
+
+    def begin(self, label, total, unit=''):
+        """ Starts reporting progress for a new task. A total of 0 means that the amount of work is unknown.
+        """
+        with self._lock:
+            self.label = label
+            self.total = total
+            self.unit = unit
+            self.done = 0
+            self.detail = ''
+            self.start_time = time()
+        self._notify(force=True)
+
+    def update(self, done, detail=None):
+        """ Sets the amount of work done since 'begin()'.
+        """
+        with self._lock:
+            self.done = min(done, self.total) if self.total else done
+            if detail is not None:
+                self.detail = detail
+            complete = self.total and self.done >= self.total
+        self._notify(force=complete)
+
+    def advance(self, amount=1, detail=None):
+        """ Increments the amount of work done.
+        """
+        with self._lock:
+            done = self.done + amount
+        self.update(done, detail)
+
+    def snapshot(self):
+        """ Returns a dictionary describing the current progress.
+
+        'fraction' and 'eta' (estimated remaining time, in seconds) are None if they cannot be computed.
+        """
+        with self._lock:
+            elapsed = time() - self.start_time
+            fraction = float(self.done) / self.total if self.total else None
+            eta = elapsed * (1.0 - fraction) / fraction if fraction else None
+            return {'label': self.label, 'detail': self.detail, 'done': self.done, 'total': self.total,
+                    'unit': self.unit, 'fraction': fraction, 'elapsed': elapsed, 'eta': eta}
+
+    def _notify(self, force=False):
+        if not self.callback:
+            return
+        now = time()
+        with self._lock:
+            if not force and now - self._last_notification < self.min_interval:
+                return
+            self._last_notification = now
+        self.callback()
+
+
+#
+# ConcurrencyLimit
+#
+
+class ConcurrencyLimit(object):
+    """
+  Limits, before a run, the number of external tools (registration, resampling,...) pyLAR runs in parallel so
+  that they fit in memory.
+
+  pyLAR starts up to 'number_of_cpu' tools at the same time and does not limit their memory. 'limit()' returns
+  the number of tools whose expected peak memory fits in 'memory_budget' bytes, and in the memory available on
+  the system minus 'reserve' bytes. The limit is computed once, before the run: running tools are neither
+  interrupted nor throttled. The peak memory of one tool is estimated from the number of voxels of the reference
+  image ('estimate()') until it has been measured: while the tools run, 'start()' and 'stop()' record the largest
+  resident memory (RSS) of one tool ('peak_rss'), which replaces the estimate to limit the next runs.
+  Measuring and checking available memory require 'psutil'. Without it, only the estimate and the budget are used.
+  """
+
+    # Memory of one SyN registration per voxel of the reference image: fixed, moving and warped images
+    # (float32), and the forward and inverse displacement fields with their update fields (4 fields of
+    # 3 double components).
+    bytes_per_voxel = 3 * 4 + 4 * 3 * 8
+
+    def __init__(self, tools, memory_budget=None, reserve=512 * 1048576, interval=2.0):
+        self.tools = set(tools)
+        self.reserve = reserve
+        self.interval = interval
+        if memory_budget is None and psutil:
+            memory_budget = int(psutil.virtual_memory().total * 0.8)
+        self.memory_budget = memory_budget
+        self.peak_rss = 0
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def estimate(self, voxels):
+        """ Returns the expected peak memory (in bytes) of one tool processing images of 'voxels' voxels.
+        """
+        return voxels * self.bytes_per_voxel
+
+    def limit(self, number_of_cpu, peak, available=None):
+        """ Returns the number of tools that can run in parallel (at least 1, at most 'number_of_cpu').
+
+        Parameters
+        ----------
+        number_of_cpu: number of tools that would run in parallel without memory limit.
+        peak: expected peak memory of one tool, in bytes.
+        available: memory available on the system, in bytes. Default: measured with 'psutil', if available.
+        """
+        if available is None and psutil:
+            available = psutil.virtual_memory().available
+        budget = self.memory_budget
+        if available is not None:
+            budget = min(budget, available - self.reserve) if budget else available - self.reserve
+        if not budget or not peak:
+            return number_of_cpu
+        return max(1, min(number_of_cpu, int(budget // peak)))
+
+    def start(self):
+        """ Starts measuring the memory used by the tools, to limit the next runs.
+        """
+        if not psutil:
+            logging.warning("'psutil' is not available. Memory used by external tools will not be measured.")
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._monitor)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self.peak_rss:
+            logging.info('Peak memory used by one external tool: %.1f MB, by all the tools: %.1f MB'
+                         % (self.peak_rss / 1048576.0, self.peak_total / 1048576.0))
+
+    def _monitor(self):
+        current = psutil.Process()
+        while not self._stop.wait(self.interval):
+            try:
+                rss = [p.memory_info().rss for p in current.children(recursive=True)
+                       if os.path.splitext(p.name())[0] in self.tools]
+            except psutil.Error:
+                continue
+            self.peak_rss = max([self.peak_rss] + rss)
+            self.peak_total = max(self.peak_total, sum(rss))
+
+
+#
+# ThreadPlanner
+#
+
+class ThreadPlanner(object):
+    """
+  Chooses how many tools pyLAR runs in parallel ('number_of_cpu') and how many threads each of these
+  ITK-based tools uses ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS') so that, together, they use each physical
+  core once instead of starting one thread per core in every tool.
+
+  By default, tools run for 'uab' and 'nglra' (ANTS registrations), and the BRAINSFit registrations of the
+  inputs of 'lr' ('BRAINSFit'), get a few threads each, without spanning more than one NUMA node, and as many
+  tools as possible are run in parallel. pyLAR runs the tools of 'lr' one at a time, so all the cores are given
+  to each tool. The number of threads per tool can be measured on the current machine with 'calibrate()'.
+  """
+
+    threads_per_tool = {'uab': 4, 'nglra': 4, 'BRAINSFit': 4}
+
+    def __init__(self, topology=None):
+        self._topology = topology
+        self.calibrated = {}  # algorithm -> number of threads per tool
+
+    def topology(self):
+        """ Returns a dictionary containing the number of logical and physical cores, and the number of
+        logical cores of each NUMA node ('nodes').
+        """
+        if self._topology is None:
+            logical = multiprocessing.cpu_count()
+            physical = (psutil.cpu_count(logical=False) if psutil else None) or logical
+            nodes = []
+            for cpulist in sorted(glob.glob('/sys/devices/system/node/node*/cpulist')):
+                try:
+                    with open(cpulist, 'r') as f:
+                        nodes.append(self._countCPUs(f.read()))
+                except (IOError, ValueError):
+                    pass
+            self._topology = {'logical': logical, 'physical': physical, 'nodes': nodes or [logical]}
+        return self._topology
+
+    def _countCPUs(self, cpulist):
+        count = 0
+        for item in cpulist.strip().split(','):
+            bounds = item.split('-')
+            count += int(bounds[-1]) - int(bounds[0]) + 1
+        return count
+
+    def plan(self, algo, number_of_images=None, number_of_cpu=None, itk_threads=None):
+        """ Returns (number_of_cpu, itk_threads). Values that are given are kept.
+
+        Parameters
+        ----------
+        algo: 'lr', 'uab', 'nglra', or 'BRAINSFit' for the registrations of the inputs of 'lr'.
+        number_of_images: number of images processed. No more tools than images are run in parallel.
+        number_of_cpu: number of tools run in parallel, if imposed.
+        itk_threads: number of threads per tool, if imposed.
+        """
+        topology = self.topology()
+        cores = topology['physical']
+        if algo not in self.threads_per_tool:
+            return 1, itk_threads or cores
+        if number_of_cpu and itk_threads:
+            return number_of_cpu, itk_threads
+        if number_of_cpu:
+            return number_of_cpu, max(1, cores // number_of_cpu)
+        if itk_threads:
+            return max(1, cores // itk_threads), itk_threads
+        cores_per_node = max(1, cores // len(topology['nodes']))
+        threads = self.calibrated.get(algo, min(self.threads_per_tool[algo], cores_per_node))
+        processes = max(1, cores // threads)
+        if number_of_images:
+            processes = min(processes, number_of_images)
+            threads = max(threads, min(cores_per_node, cores // processes))
+        return processes, threads
+
+    def calibrate(self, algo, command, candidates=None):
+        """ Measures which number of threads per tool gives the highest throughput and uses it for 'algo'.
+
+        For each candidate number of threads 't', (number of physical cores / t) copies of the command are
+        run in parallel with ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS set to 't'.
+
+        Parameters
+        ----------
+        algo: algorithm (or 'BRAINSFit') for which the result is used.
+        command: callable returning the command line (list) of the copy number given as argument.
+        candidates: numbers of threads to try. Default: powers of 2 up to the size of a NUMA node.
+
+        Returns
+        -------
+        Dictionary of throughput (commands per second) for each candidate.
+        """
+        topology = self.topology()
+        cores = topology['physical']
+        if not candidates:
+            cores_per_node = max(1, cores // len(topology['nodes']))
+            candidates = [2 ** i for i in range(0, 16) if 2 ** i <= cores_per_node]
+        throughput = {}
+        for threads in candidates:
+            env = dict(os.environ)
+            env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+            copies = max(1, cores // threads)
+            start_time = time()
+            processes = [subprocess.Popen(command(i), env=env) for i in range(copies)]
+            status = []
+            for p in processes:
+                status.append(p.wait())
+                WorkerProfiler.record(os.path.basename(command(0)[0]), time() - start_time)
+            if any(status):
+                raise Exception('Calibration command failed: %s' % ' '.join(command(0)))
+            throughput[threads] = copies / max(time() - start_time, 1e-6)
+            logging.info('Calibration: %d threads per tool, %.2f tools per second' % (threads, throughput[threads]))
+        self.calibrated[algo] = max(throughput, key=throughput.get)
+        return throughput
+
+
+#
+# ResultVolumeCache
+#
+
+class ResultVolumeCache(object):
+    """
+  Adds volumes to the scene as placeholders and loads their voxel data only when they are displayed.
+
+  A placeholder is a scalar volume node with a storage node pointing to the file, but no image data.
+  Slice views are observed: when a placeholder is displayed, its file is read. The memory used by the
+  volumes loaded by this cache is limited to 'memory_cap' bytes: the least recently displayed volumes that
+  are not displayed anymore are unloaded (their image data is released and read again if needed).
+  Images stored with 'SparseImage' are expanded when they are loaded.
+  Must only be used from Slicer's main thread.
+  """
+
+    def __init__(self, memory_cap):
+        self.memory_cap = memory_cap
+        self.loaded = collections.OrderedDict()  # node ID -> memory size in bytes, least recently displayed first
+        self.placeholders = set()  # IDs of all the nodes managed by the cache
+        self._observed = {}  # slice composite node ID -> observer tag
+
+    def add(self, name, filepath):
+        """ Adds a placeholder node named 'name' for the volume stored in 'filepath'. Returns the node.
+        """
+        node = slicer.vtkMRMLScalarVolumeNode()
+        node.SetName(name)
+        slicer.mrmlScene.AddNode(node)
+        if SparseImage.isSparse(filepath):
+            node.SetAttribute('LowRankImageDecomposition.SparseImage', filepath)
+        else:
+            storageNode = slicer.vtkMRMLVolumeArchetypeStorageNode()
+            storageNode.SetFileName(filepath)
+            slicer.mrmlScene.AddNode(storageNode)
+            node.SetAndObserveStorageNodeID(storageNode.GetID())
+        self.placeholders.add(node.GetID())
+        self._observeSliceViews()
+        return node
+
+    def clear(self):
+        """ Stops observing slice views. Nodes stay in the scene.
+        """
+        for nodeID, tag in self._observed.items():
+            sliceCompositeNode = slicer.mrmlScene.GetNodeByID(nodeID)
+            if sliceCompositeNode:
+                sliceCompositeNode.RemoveObserver(tag)
+        self._observed = {}
+
+    def _observeSliceViews(self):
+        sliceCompositeNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLSliceCompositeNode')
+        for i in range(sliceCompositeNodes.GetNumberOfItems()):
+            sliceCompositeNode = sliceCompositeNodes.GetItemAsObject(i)
+            if sliceCompositeNode.GetID() not in self._observed:
+                tag = sliceCompositeNode.AddObserver(vtk.vtkCommand.ModifiedEvent, self.onSliceViewModified)
+                self._observed[sliceCompositeNode.GetID()] = tag
+
+    def filePaths(self):
+        """ Returns the files read by the managed nodes that are still in the scene.
+        """
+        paths = []
+        for nodeID in list(self.placeholders):
+            node = slicer.mrmlScene.GetNodeByID(nodeID)
+            if not node:
+                self.placeholders.discard(nodeID)
+                continue
+            storageNode = node.GetStorageNode()
+            paths.append(node.GetAttribute('LowRankImageDecomposition.SparseImage')
+                         or (storageNode.GetFileName() if storageNode else None))
+        return [path for path in paths if path]
+
+    def displayedNodeIDs(self):
+        """ Returns the IDs of the managed nodes that are displayed in a slice view.
+        """
+        displayed = set()
+        sliceCompositeNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLSliceCompositeNode')
+        for i in range(sliceCompositeNodes.GetNumberOfItems()):
+            sliceCompositeNode = sliceCompositeNodes.GetItemAsObject(i)
+            displayed.update([sliceCompositeNode.GetBackgroundVolumeID(),
+                              sliceCompositeNode.GetForegroundVolumeID(),
+                              sliceCompositeNode.GetLabelVolumeID()])
+        return displayed & self.placeholders
+
+    def onSliceViewModified(self, caller=None, event=None):
+        displayed = self.displayedNodeIDs()
+        for nodeID in displayed:
+            node = slicer.mrmlScene.GetNodeByID(nodeID)
+            if not node:
+                self.placeholders.discard(nodeID)
+                continue
+            if nodeID in self.loaded:
+                # Mark as most recently displayed
+                self.loaded[nodeID] = self.loaded.pop(nodeID)
+            else:
+                self.load(node)
+        self.evict(displayed)
+
+    def load(self, node):
+        """ Reads the voxel data of a placeholder node.
+        """
+        logging.info('Loading %s...' % node.GetName())
+        sparse_fn = node.GetAttribute('LowRankImageDecomposition.SparseImage')
+        if sparse_fn:
+            import sitkUtils
+            sitkUtils.PushVolumeToSlicer(SparseImage.read(sparse_fn), targetNode=node)
+        elif not node.GetStorageNode().ReadData(node):
+            logging.warning('Error loading %s...' % node.GetName())
+            return
+        if not node.GetDisplayNode():
+            node.CreateDefaultDisplayNodes()
+        self.loaded[node.GetID()] = node.GetImageData().GetActualMemorySize() * 1024
+
+    def evict(self, displayed=()):
+        """ Unloads the least recently displayed volumes until the memory cap is respected.
+        Volumes that are displayed are never unloaded.
+        """
+        for nodeID in list(self.loaded.keys()):
+            if sum(self.loaded.values()) <= self.memory_cap:
+                break
+            if nodeID in displayed:
+                continue
+            size = self.loaded.pop(nodeID)
+            node = slicer.mrmlScene.GetNodeByID(nodeID)
+            if node:
+                logging.info('Unloading %s (%.1f MB)' % (node.GetName(), size / 1048576.0))
+                node.SetAndObserveImageData(None)
+            else:
+                self.placeholders.discard(nodeID)
+
+
+#
+# WorkerProfiler
+#
+
+class WorkerProfiler(object):
+    """
+  Profiles a callable run in a worker thread with cProfile, and measures separately the time spent in
+  external tools.
+
+  Only the Python code of the thread running the callable is profiled. The external tools run by this module
+  are started with 'WorkerProfiler.call()' (or timed with 'WorkerProfiler.record()'), which records their
+  duration in the profilers running at that time. Tools run by pyLAR are only included in the total CPU time
+  of the child processes. The profile is saved in 'output_dir' ('profile_<name>_<date>.prof', readable with 'pstats' or snakeviz),
+  with a text summary of the external tools and of the 'top' functions with the largest cumulative and
+  internal times ('profile_<name>_<date>.txt').
+  """
+
+    _lock = threading.Lock()
+    _active = []  # Profilers currently running
+
+    def __init__(self, output_dir, top=30):
+        self.output_dir = output_dir
+        self.top = top
+        self.tools = collections.defaultdict(lambda: [0, 0.0])  # tool name -> [number of processes, time]
+
+    def runcall(self, f, *args, **kwargs):
+        """ Runs f(*args, **kwargs) with profiling and saves the results. Returns the value returned by 'f'.
+        """
+        import cProfile
+        profiler = cProfile.Profile()
+        with WorkerProfiler._lock:
+            WorkerProfiler._active.append(self)
+        start_time = time()
+        start_times = os.times()
+        try:
+            return profiler.runcall(f, *args, **kwargs)
+        finally:
+            with WorkerProfiler._lock:
+                WorkerProfiler._active.remove(self)
+            elapsed = time() - start_time
+            children_time = sum(os.times()[2:4]) - sum(start_times[2:4])
+            try:
+                self.save(profiler, getattr(f, '__name__', 'worker'), elapsed, children_time)
+            except (IOError, OSError) as e:
+                logging.warning('Could not save profile in %s: %s' % (self.output_dir, e))
+
+    def save(self, profiler, name, elapsed, children_time):
+        import pstats
+        import datetime
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+        date = datetime.datetime.now().strftime('%Y%m%d-%H%M%S')
+        prefix = os.path.join(self.output_dir, 'profile_%s_%s' % (name, date))
+        profiler.dump_stats(prefix + '.prof')
+        with open(prefix + '.txt', 'w') as f:
+            f.write('Profile of %s: %.3f s\n' % (name, elapsed))
+            f.write('CPU time of all the external tools that finished (including pyLAR tools): %.3f s\n\n'
+                    % children_time)
+            f.write('%-40s %10s %12s\n' % ('External tool run by this module', 'Processes', 'Time (s)'))
+            for tool, (count, tool_time) in sorted(self.tools.items(), key=lambda item: -item[1][1]):
+                f.write('%-40s %10d %12.3f\n' % (tool, count, tool_time))
+            f.write('\n')
+            stats = pstats.Stats(profiler, stream=f)
+            stats.sort_stats('cumulative').print_stats(self.top)
+            stats.sort_stats('time').print_stats(self.top)
+        logging.info('Profile saved in %s.prof (summary: %s.txt)' % (prefix, prefix))
+        return prefix
+
+    @classmethod
+    def record(cls, tool, elapsed):
+        """ Records that the external tool 'tool' ran for 'elapsed' seconds in the profilers currently running.
+        """
+        with cls._lock:
+            for profiler in cls._active:
+                profiler.tools[tool][0] += 1
+                profiler.tools[tool][1] += elapsed
+
+    @classmethod
+    def call(cls, command, **kwargs):
+        """ Runs 'command' with 'subprocess.call()' and records its duration. Returns the exit code.
+        """
+        start_time = time()
+        try:
+            return subprocess.call(command, **kwargs)
+        finally:
+            cls.record(os.path.basename(command[0]), time() - start_time)
+
+
+#
+# SparseImage
+#
+
+class SparseImage(object):
+    """
+  Compact storage of images that are mostly zeros, such as the sparse components computed by 'lr'.
+
+  Only the non-zero voxels are stored: their indices (delta-encoded, in the order of the voxels in memory)
+  and their values, together with the geometry of the image (size, spacing, origin, direction), in a
+  compressed numpy file ('.sparse.npz'). 'read' expands the file into a full SimpleITK image.
+  """
+
+    extension = '.sparse.npz'
+    # Sparse images are recognized by an 'S' token (e.g. 'S_0.nrrd', 'Iter1_S_3.nrrd') or a '_Sparse' suffix
+    sparse_pattern = re.compile(r'(?:^|_)S(?:_|\d|\.)|_Sparse\.')
+
+    @classmethod
+    def isSparse(cls, filename):
+        return filename.endswith(cls.extension)
+
+    @classmethod
+    def baseName(cls, filename):
+        """ Returns the file name without directory and extension.
+        """
+        name = os.path.basename(filename)
+        if cls.isSparse(name):
+            return name[:-len(cls.extension)]
+        return os.path.splitext(name)[0]
+
+    @classmethod
+    def write(cls, image, filename):
+        array = sitk.GetArrayFromImage(image).ravel()
+        indices = numpy.flatnonzero(array)
+        deltas = numpy.diff(numpy.concatenate(([0], indices))).astype(numpy.uint32)
+        numpy.savez_compressed(filename, deltas=deltas, values=array[indices], size=image.GetSize(),
+                               spacing=image.GetSpacing(), origin=image.GetOrigin(), direction=image.GetDirection())
+
+    @classmethod
+    def read(cls, filename):
+        data = numpy.load(filename)
+        size = [int(s) for s in data['size']]
+        values = data['values']
+        array = numpy.zeros(int(numpy.prod(size)), dtype=values.dtype)
+        array[numpy.cumsum(data['deltas'].astype(numpy.int64))] = values
+        image = sitk.GetImageFromArray(array.reshape(size[::-1]))
+        image.SetSpacing([float(s) for s in data['spacing']])
+        image.SetOrigin([float(o) for o in data['origin']])
+        image.SetDirection([float(d) for d in data['direction']])
+        return image
+
+    @classmethod
+    def compress(cls, filename):
+        """ Replaces the image stored in 'filename' by its compact version. Returns the new file name.
+        """
+        sparse_fn = os.path.join(os.path.dirname(filename), cls.baseName(filename) + cls.extension)
+        cls.write(sitk.ReadImage(filename), sparse_fn)
+        os.remove(filename)
+        return sparse_fn
+
+
+#
+# InputValidator
+#
+
+class InputValidator(object):
+    """
+  Checks the input images of a run before it starts, by reading only their headers (in parallel).
+
+  Every image must exist, have a readable header, be a scalar image and have the same dimension as the
+  reference image. If 'same_grid' is set (images that are not registered), pixel type, size, spacing and
+  orientation must also match the reference image.
+  """
+
+    def __init__(self, reference_fn, same_grid=False, threads=8):
+        self.reference_fn = reference_fn
+        self.same_grid = same_grid
+        self.threads = threads
+
+    @staticmethod
+    def header(filename):
+        """ Returns a dictionary describing the image stored in 'filename', or a string describing the problem.
+        """
+        if not os.path.isfile(filename):
+            return 'file not found'
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(filename)
+        try:
+            reader.ReadImageInformation()
+        except RuntimeError as e:
+            lines = str(e).strip().splitlines()
+            return 'cannot read image header (%s)' % (lines[-1] if lines else 'unknown error')
+        return {'dimension': reader.GetDimension(), 'components': reader.GetNumberOfComponents(),
+                'pixel type': sitk.GetPixelIDValueAsString(reader.GetPixelID()), 'size': reader.GetSize(),
+                'spacing': reader.GetSpacing(), 'direction': reader.GetDirection()}
+
+    def validate(self, filenames):
+        """ Returns the list of problems found, as (file name, description) pairs.
+        """
+        filenames = list(filenames)
+        pool = ThreadPool(max(1, min(self.threads, len(filenames) + 1)))
+        try:
+            headers = pool.map(self.header, [self.reference_fn] + filenames)
+        finally:
+            pool.close()
+            pool.join()
+        reference = headers[0]
+        if isinstance(reference, basestring):
+            return [(self.reference_fn, 'reference image: ' + reference)]
+        problems = []
+        for filename, header in zip(filenames, headers[1:]):
+            if isinstance(header, basestring):
+                problems.append((filename, header))
+                continue
+            if header['components'] != 1:
+                problems.append((filename, 'image has %d components, only scalar images are supported'
+                                 % header['components']))
+            if header['dimension'] != reference['dimension']:
+                problems.append((filename, 'dimension is %d, reference image dimension is %d'
+                                 % (header['dimension'], reference['dimension'])))
+                continue
+            if not self.same_grid:
+                continue
+            for key in ['pixel type', 'size']:
+                if header[key] != reference[key]:
+                    problems.append((filename, '%s is %s, reference image %s is %s'
+                                     % (key, header[key], key, reference[key])))
+            for key in ['spacing', 'direction']:
+                if not numpy.allclose(header[key], reference[key], rtol=1e-4, atol=1e-6):
+                    problems.append((filename, '%s is %s, reference image %s is %s'
+                                     % (key, tuple(header[key]), key, tuple(reference[key]))))
+        return problems
+
+
+#
+# LowRankBasis
+#
+
+class LowRankBasis(object):
+    """
+  Orthonormal basis of the low-rank images computed by a previous 'lr' run, used to decompose new images
+  without running the decomposition on the whole cohort again.
+
+  The basis is computed from the low-rank images listed in 'list_outputs.txt' of the previous result
+  directory and is saved in that directory ('low_rank_basis.npz'), so it is only computed once.
+  'list_outputs.txt' of an 'lr' run lists the low-rank images of the selected images, followed by their
+  sparse images. The number of selected images, and how they were registered and preprocessed, are recorded
+  in the result directory at the end of the run ('low_rank_parameters.json', see 'saveParameters()').
+  A new image is resampled on the grid of the low-rank images and projected on the basis: the projection is
+  its low-rank component and the residual is its sparse component. The basis itself is not modified, so the
+  decomposition of the cohort is not influenced by the new images.
+  """
+
+    file_name = 'low_rank_basis.npz'
+    parameters_file_name = 'low_rank_parameters.json'
+
+    def __init__(self, basis, singular_values, reference_fn):
+        self.basis = basis
+        self.singular_values = singular_values
+        self.reference_fn = reference_fn
+
+    @classmethod
+    def fromResultDir(cls, result_dir, tolerance=1e-3):
+        """ Loads the basis saved in 'result_dir', or computes and saves it if it does not exist.
+
+        Parameters
+        ----------
+        result_dir: result directory of a previous 'lr' run.
+        tolerance: singular values smaller than 'tolerance' times the largest one are discarded.
+        """
+        basis_fn = os.path.join(result_dir, cls.file_name)
+        if os.path.isfile(basis_fn):
+            data = numpy.load(basis_fn)
+            return cls(data['basis'], data['singular_values'], str(data['reference_fn']))
+        list_outputs_fn = os.path.join(result_dir, 'list_outputs.txt')
+        outputs = pyLAR.readTxtIntoList(list_outputs_fn)
+        number_of_images = (cls.loadParameters(result_dir) or {}).get('number_of_images', len(outputs) // 2)
+        if not number_of_images or len(outputs) != 2 * number_of_images:
+            raise Exception('%s should list %d low-rank images and %d sparse images. Got %d images.'
+                            % (list_outputs_fn, number_of_images, number_of_images, len(outputs)))
+        low_rank_fns = outputs[:number_of_images]
+        reference = sitk.ReadImage(low_rank_fns[0])
+        matrix = numpy.column_stack([cls._vector(sitk.ReadImage(f), reference) for f in low_rank_fns])
+        u, singular_values, v = numpy.linalg.svd(matrix, full_matrices=False)
+        rank = int(numpy.sum(singular_values > tolerance * singular_values[0]))
+        basis = cls(u[:, :rank], singular_values[:rank], low_rank_fns[0])
+        numpy.savez(basis_fn, basis=basis.basis, singular_values=basis.singular_values,
+                    reference_fn=basis.reference_fn)
+        logging.info('Low-rank basis of rank %d computed from %d images' % (rank, len(low_rank_fns)))
+        return basis
+
+    @classmethod
+    def saveParameters(cls, result_dir, config):
+        """ Records the number of selected images of the 'lr' run whose outputs are in 'result_dir', and how
+        they were registered and preprocessed, so that new images can be processed the same way.
+
+        Parameters
+        ----------
+        config: configuration of the run.
+        """
+        parameters = {'number_of_images': len(config.selection),
+                      'reference_im_fn': getattr(config, 'reference_im_fn', None),
+                      'registration': getattr(config, 'registration', 'none'),
+                      'histogram_matching': bool(getattr(config, 'histogram_matching', False)),
+                      'sigma': getattr(config, 'sigma', 0)}
+        with open(os.path.join(result_dir, cls.parameters_file_name), 'w') as f:
+            json.dump(parameters, f)
+
+    @classmethod
+    def loadParameters(cls, result_dir):
+        """ Returns the parameters recorded with 'saveParameters()', or None if 'result_dir' does not contain them.
+        """
+        try:
+            with open(os.path.join(result_dir, cls.parameters_file_name), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    @staticmethod
+    def _vector(image, reference):
+        """ Resamples 'image' on the grid of 'reference' and returns its voxels as a vector.
+        """
+        image = sitk.Resample(image, reference, sitk.Transform(), sitk.sitkLinear, 0.0, sitk.sitkFloat64)
+        return sitk.GetArrayFromImage(image).ravel()
+
+    def decompose(self, image_fn, low_rank_fn, sparse_fn):
+        """ Writes the low-rank and sparse components of 'image_fn'.
+        """
+        reference = sitk.ReadImage(self.reference_fn)
+        vector = self._vector(sitk.ReadImage(image_fn), reference)
+        low_rank = self.basis.dot(self.basis.T.dot(vector))
+        for array, filename in ((low_rank, low_rank_fn), (vector - low_rank, sparse_fn)):
+            image = sitk.GetImageFromArray(array.reshape(sitk.GetArrayFromImage(reference).shape).astype(numpy.float32))
+            image.CopyInformation(reference)
+            sitk.WriteImage(image, filename)
+
+
+#
+# MaskedLowRankDecomposition
+#
+
+class MaskedLowRankDecomposition(object):
+    """
+  Low-rank/sparse decomposition of the voxels of images inside a mask, used for masked 'lr' decompositions
+  and parameter sweeps (see 'LowRankImageDecompositionLogic.thread_maskedLowRank()' and 'thread_sweep()').
+
+  The decomposition is computed with the inexact augmented Lagrange multiplier method (Lin et al., 2010)
+  on the matrix whose columns are the images. The weight of the sparse component is
+  lamda / sqrt(max(number of voxels, number of images)).
+  A decomposition can be started from the solution of a previous value of 'lamda' (warm start), which
+  usually converges in fewer iterations than starting from zero.
+  If a mask is given, only the voxels inside the mask are decomposed, which makes the matrix much smaller
+  when most of the images is background. Written images are set to 0 outside of the mask.
+  """
+
+    def __init__(self, images, tolerance=1e-7, max_iterations=1000, mask=None):
+        """
+        Parameters
+        ----------
+        images: list of SimpleITK images that share the same grid.
+        mask: SimpleITK image. Voxels with a non-zero value are decomposed. The mask is resampled on the grid
+              of the images (nearest neighbor).
+        """
+        self.reference = images[0]
+        self.shape = sitk.GetArrayFromImage(self.reference).shape
+        self.indices = None
+        if mask is not None:
+            mask = sitk.Resample(mask, self.reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+            self.indices = numpy.flatnonzero(sitk.GetArrayFromImage(mask))
+            if not len(self.indices):
+                raise Exception('Mask does not contain any voxel of the images')
+        self.data = numpy.column_stack([self._vector(image) for image in images])
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+
+    def _vector(self, image):
+        vector = sitk.GetArrayFromImage(image).ravel().astype(numpy.float32)
+        if self.indices is not None:
+            return vector[self.indices]
+        return vector
+
+    def decompose(self, lamda, start=None):
+        """ Decomposes the data matrix. Returns a dictionary containing the low-rank ('L') and sparse ('S')
+        matrices, the Lagrange multiplier ('Y'), and statistics ('rank', 'sparsity', 'residual', 'objective'
+        (nuclear norm of L + weight * l1 norm of S), 'iterations').
+
+        Parameters
+        ----------
+        lamda: weight of the sparse component (see class description).
+        start: result of a previous call, used as starting point.
+        """
+        D = self.data
+        weight = lamda / numpy.sqrt(max(D.shape))
+        d_norm = numpy.linalg.norm(D)
+        norm_two = numpy.linalg.svd(D, compute_uv=False)[0]
+        mu = 1.25 / norm_two
+        mu_max = mu * 1e7
+        rho = 1.5
+        if start:
+            # The penalty 'mu' is restarted: starting with the large final value of the previous
+            # decomposition would keep the solution close to the previous one.
+            S, Y = start['S'], start['Y']
+        else:
+            S = numpy.zeros_like(D)
+            Y = D / max(norm_two, numpy.abs(D).max() / weight)
+        rank = 0
+        for iteration in range(1, self.max_iterations + 1):
+            U, sigma, Vt = numpy.linalg.svd(D - S + Y / mu, full_matrices=False)
+            rank = int(numpy.sum(sigma > 1.0 / mu))
+            L = numpy.dot(U[:, :rank] * (sigma[:rank] - 1.0 / mu), Vt[:rank])
+            T = D - L + Y / mu
+            S = numpy.sign(T) * numpy.maximum(numpy.abs(T) - weight / mu, 0)
+            Z = D - L - S
+            Y = Y + mu * Z
+            mu = min(mu * rho, mu_max)
+            if numpy.linalg.norm(Z) / d_norm < self.tolerance:
+                break
+        objective = numpy.linalg.svd(L, compute_uv=False).sum() + weight * numpy.abs(S).sum()
+        return {'L': L, 'S': S, 'Y': Y, 'rank': rank, 'iterations': iteration, 'objective': float(objective),
+                'sparsity': float(numpy.count_nonzero(S)) / S.size,
+                'residual': float(numpy.linalg.norm(D - L - S) / d_norm)}
+
+    def writeImages(self, result, output_dir, names):
+        """ Writes the low-rank and sparse images of a decomposition and lists them in 'list_outputs.txt'.
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        list_images = []
+        for component in ('L', 'S'):
+            for i, name in enumerate(names):
+                array = result[component][:, i]
+                if self.indices is not None:
+                    array = numpy.zeros(self.reference.GetNumberOfPixels(), dtype=array.dtype)
+                    array[self.indices] = result[component][:, i]
+                image = sitk.GetImageFromArray(array.reshape(self.shape))
+                image.CopyInformation(self.reference)
+                filename = os.path.join(output_dir, '%s_%d_%s.nrrd' % (component, i, name))
+                sitk.WriteImage(image, filename)
+                list_images.append(filename)
+        pyLAR.writeTxtFromList(os.path.join(output_dir, 'list_outputs.txt'), list_images)
+        return list_images
+
+
 #
 # LowRankImageDecompositionLogic
 #
@@ -378,6 +1364,19 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         self.post_queue_timer.connect('timeout()', self.post_queue_process)
         self.thread = threading.Thread()
         self.abort = False
+        self.profiling = False  # Profile the processing threads (see 'WorkerProfiler')
+        self.profile_dir = None  # Directory in which the profile of the next processing thread is saved
+        self._ingest = None  # Uncompressed cache used by the current download
+        self.progress = ProgressTracker(self._progressChanged)
+        self._progress_pending = False
+        self.threadPlanner = ThreadPlanner()
+        self.toolPeakMemory = {}  # algorithm -> peak memory of one tool measured during the last run (bytes)
+        self.resultVolumes = None
+        self.sparseVolumes = None
+        self._preprocessingCache = None
+        self._resultStore = None
+        self._runCache = None
+        self.registry = DatasetRegistry(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Data'))
 
     def __del__(self):
         # Stop the queues before deleting the object
@@ -389,6 +1388,97 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         if self.thread.is_alive():
             self.thread.join()
 
+    def setLazyLoading(self, enabled, memory_cap=2048):
+        """ Selects whether images are loaded in Slicer when they are downloaded or computed, or only
+        added as placeholders that are loaded when displayed (see 'ResultVolumeCache').
+
+        Parameters
+        ----------
+        enabled: boolean
+        memory_cap: maximum memory (in MB) used by the volumes loaded on demand.
+        """
+        if self.sparseVolumes:
+            self.sparseVolumes.clear()
+            self.sparseVolumes = None
+        if not enabled:
+            if self.resultVolumes:
+                self.resultVolumes.clear()
+            self.resultVolumes = None
+        elif self.resultVolumes:
+            self.resultVolumes.memory_cap = memory_cap * 1048576
+            self.resultVolumes.evict(self.resultVolumes.displayedNodeIDs())
+        else:
+            self.resultVolumes = ResultVolumeCache(memory_cap * 1048576)
+
+    def resultStore(self):
+        """ Returns the manager of the result directories written in Slicer's temporary directory.
+
+        Quota and retention are read from the application settings 'LowRankImageDecomposition/ResultsQuota'
+        (in MB) and 'LowRankImageDecomposition/ResultsRetention' (in days). Both are disabled if not set.
+        """
+        if not self._resultStore:
+            self._resultStore = ResultStore(slicer.app.temporaryPath)
+        settings = slicer.app.settings()
+        quota = settings.value('LowRankImageDecomposition/ResultsQuota')
+        retention = settings.value('LowRankImageDecomposition/ResultsRetention')
+        self._resultStore.quota = float(quota) * 1048576 if quota else None
+        self._resultStore.retention = float(retention) * 86400 if retention else None
+        return self._resultStore
+
+    def preprocessingCache(self):
+        """ Returns the cache of preprocessed images, stored in Slicer's cache directory. It also memoizes the file
+        hashes used by the run cache.
+
+        Its maximum size is given by the 'preprocessing_cache' field of the configurations that use it.
+        """
+        if not self._preprocessingCache:
+            self._preprocessingCache = PreprocessingCache(
+                os.path.join(slicer.app.settings().value('Cache/Path'), 'pyLARPreprocessing'))
+        return self._preprocessingCache
+
+    def runCache(self):
+        """ Returns the cache of complete runs, stored in Slicer's cache directory.
+
+        Its maximum size is read from the application setting 'LowRankImageDecomposition/RunCacheSize' (in MB,
+        default: 5 GB).
+        """
+        if not self._runCache:
+            self._runCache = RunCache(os.path.join(slicer.app.settings().value('Cache/Path'), 'pyLARRuns'),
+                                      self.preprocessingCache().fileHash)
+        max_size = slicer.app.settings().value('LowRankImageDecomposition/RunCacheSize')
+        self._runCache.max_size = float(max_size) * 1048576 if max_size else 5 * 1024 ** 3
+        return self._runCache
+
+    def uncompressedCache(self):
+        """ Returns the cache of uncompressed copies of the downloaded images if the application setting
+        'LowRankImageDecomposition/UncompressedCache' is 'true', None otherwise (see 'UncompressedCache').
+        Its maximum size is read from the application setting 'LowRankImageDecomposition/UncompressedCacheSize'
+        (in MB, default: 5 GB).
+        """
+        settings = slicer.app.settings()
+        if settings.value('LowRankImageDecomposition/UncompressedCache') not in ('true', True):
+            return None
+        max_size = settings.value('LowRankImageDecomposition/UncompressedCacheSize')
+        return UncompressedCache(os.path.join(settings.value('Cache/Path'), 'pyLARUncompressed'),
+                                 float(max_size) * 1048576 if max_size else 5 * 1024 ** 3)
+
+    def _uncompressedInputs(self, im_fns, selection):
+        """ Replaces the selected images of the cache directory by their uncompressed copy, if enabled.
+
+        Copies that are not used by the selected images are removed if the cache exceeds its maximum size.
+        """
+        cache = self.uncompressedCache()
+        if not cache:
+            return im_fns
+        cache_dir = self._normalize_path(slicer.app.settings().value('Cache/Path'))
+        im_fns = list(im_fns)
+        for i in selection:
+            if i < len(im_fns) and os.path.isfile(im_fns[i]) \
+                    and self._normalize_path(os.path.dirname(im_fns[i])) == cache_dir:
+                im_fns[i] = cache.get(im_fns[i])
+        cache.evict(keep=[im_fns[i] for i in selection if i < len(im_fns)])
+        return im_fns
+
     def yieldPythonGIL(self, seconds=0):
         """ Pause to yield Python GIL.
         """
@@ -399,6 +1489,8 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
 
         Once callable is done running, adds 'main_queue_stop' to cleanly
         terminate multithreaded process.
+        If 'profile_dir' is set, the callable is profiled and the profile is saved in 'profile_dir'
+        (see 'WorkerProfiler').
 
         Parameters
         ----------
@@ -408,7 +1500,10 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         """
         try:
             if callable(f):
-                f(*args, **kwargs)
+                if self.profile_dir:
+                    WorkerProfiler(self.profile_dir).runcall(f, *args, **kwargs)
+                else:
+                    f(*args, **kwargs)
             else:
                 logging.error("Not a callable.")
         except Exception as e:
@@ -443,6 +1538,8 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         As a work around, this post_queue_process is run automatically, started by a QTimer, and checks if
         new image have been added to the queue. Since this is running in Slicer's main thread, this can load
         image into Slicer.
+        Images stored with 'SparseImage' are always added as placeholders that are expanded when displayed
+        (see 'ResultVolumeCache').
         """
         loader = slicer.util.loadVolume
         if not loader:
@@ -453,6 +1550,14 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
                 if self.abort:
                     break
                 name, filepath = self.post_queue.get_nowait()
+                if self.resultVolumes:
+                    self.resultVolumes.add(SparseImage.baseName(filepath), filepath)
+                    continue
+                if SparseImage.isSparse(filepath):
+                    if not self.sparseVolumes:
+                        self.sparseVolumes = ResultVolumeCache(2048 * 1048576)
+                    self.sparseVolumes.add(SparseImage.baseName(filepath), filepath)
+                    continue
                 logging.info('Loading %s...' % (name,))
                 if loader(filepath):
                     logging.info('done loading %s...' % (name,))
@@ -486,6 +1591,19 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
             self.thread.join()
         slicer.modules.LowRankImageDecompositionWidget.onLogicRunStop()
 
+    def _progressChanged(self):
+        """ Called from the processing thread when progress should be displayed.
+
+        At most one refresh is waiting in main_queue at any time.
+        """
+        if not self._progress_pending:
+            self._progress_pending = True
+            self.main_queue.put(self._progressRefresh)
+
+    def _progressRefresh(self):
+        self._progress_pending = False
+        slicer.modules.LowRankImageDecompositionWidget.onProgress(self.progress.snapshot())
+
     def main_queue_process(self):
         """ Processes the main_queue of callables
         """
@@ -531,7 +1649,51 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         os.environ["PATH"] = savedPATH
         return software
 
-    def run_pyLAR(self, configFile, algo, node=None):
+    def calibrateThreads(self, algo, reference_im_fn, moving_im_fn, ants_params=None):
+        """ Measures the best number of threads per tool on this machine for the given algorithm.
+
+        For 'uab' and 'nglra', 'moving_im_fn' is registered to the reference image with antsRegistration and the
+        ANTS parameters of the configuration ('ants_params', default: the default of 'createConfiguration()'), as
+        pyLAR does, with 10 times fewer iterations to keep the calibration short. For 'lr', it is registered with
+        BRAINSFit, as the inputs of 'lr' are, with a few iterations. Many tools are run in parallel, for
+        different numbers of threads per tool. The result is used by the next calls to 'createConfiguration()'
+        with 'plan_threads' ('uab', 'nglra') and by the next registrations of the inputs of 'lr'.
+        """
+        software = self.softwarePaths()
+        output_dir = os.path.join(slicer.app.temporaryPath, 'calibration')
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        if algo == 'lr':
+            tool = 'BRAINSFit'
+
+            def command(i):
+                return [software.EXE_BRAINSFit, '--fixedVolume', reference_im_fn, '--movingVolume', moving_im_fn,
+                        '--outputVolume', os.path.join(output_dir, 'calibration%d.nrrd' % i),
+                        '--transformType', 'Rigid', '--initializeTransformMode', 'useMomentsAlign',
+                        '--numberOfIterations', '50']
+        else:
+            tool = algo
+            if ants_params is None:
+                ants_params = self.createConfiguration(algo, reference_im_fn, None, []).ants_params
+            metric = ants_params['Metric'].replace('fixedIm', reference_im_fn).replace('movingIm', moving_im_fn)
+            # '[100x50x25,1e-6,10]' -> '[10x5x2,1e-6,10]'
+            iterations, separator, convergence = ants_params['Convergence'].strip('[]').partition(',')
+            iterations = 'x'.join([str(max(1, int(n) // 10)) for n in iterations.split('x')])
+            convergence = '[' + iterations + separator + convergence + ']'
+
+            def command(i):
+                prefix = os.path.join(output_dir, 'calibration%d_' % i)
+                return [software.EXE_antsRegistration, '-d', str(ants_params['Dimension']), '--float', '1',
+                        '--output', '[%s,%sWarped.nrrd]' % (prefix, prefix),
+                        '-t', ants_params['Transform'], '-m', metric, '-c', convergence,
+                        '-f', ants_params['ShrinkFactors'], '-s', ants_params['SmoothingSigmas']]
+
+        try:
+            return self.threadPlanner.calibrate(tool, command)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    def run_pyLAR(self, configFile, algo, node=None, datafile=None, mask=None):
         """ Entry point to asynchronously run pyLAR algorithm from Slicer module.
 
         If no thread has already been started (unfinished data download or previous pyLAR computation):
@@ -540,6 +1702,22 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         - Setup pyLAR processing thread.
         - Starts pyLAR processing in main_queue
         - Starts post_queue to asynchronously load data in Slicer
+
+        If 'datafile' (JSON file containing image information) is given, the selected input images are
+        downloaded in the processing thread, and pyLAR is started as soon as they are available
+        (see 'thread_pipelinedPyLAR()'). Without 'datafile', selected input images that are missing from
+        the cache directory but are listed in one of the JSON files in 'Data' are downloaded the same way.
+        Images that are not selected are never downloaded.
+
+        For 'lr', if a node is given and the configuration contains 'previous_result_dir', only the image of the
+        node is decomposed, using the low-rank basis of the previous run (see 'thread_incrementalLowRank()').
+
+        For 'lr', 'mask' (file name, vtkMRMLLabelMapVolumeNode or vtkMRMLSegmentationNode) restricts the
+        decomposition to the voxels inside the mask, and overrides 'mask_fn' of the configuration file
+        (see 'thread_pyLAR()').
+
+        If 'profiling' is set, or if the configuration contains 'profile = True', the processing thread is
+        profiled and the profile is saved in the result directory (see 'WorkerProfiler').
     """
         # Check that pyLAR is not already running:
         try:
@@ -555,9 +1733,23 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         result_dir = config.result_dir
         file_list_file_name = self._normalize_path(config.file_list_file_name)
         im_fns = pyLAR.readTxtIntoList(file_list_file_name)
+        previous_result_dir = getattr(config, 'previous_result_dir', None)
+        if previous_result_dir and os.path.realpath(previous_result_dir) == os.path.realpath(result_dir):
+            raise Exception("'previous_result_dir' and 'result_dir' must be different directories")
         # 'clean' needs to be done before configuring the logger that creates a file in the output directory
+        # The previous results are moved aside and deleted in the background
         if os.path.isdir(result_dir) and hasattr(config, "clean") and config.clean:
-            shutil.rmtree(result_dir)
+            self.resultStore().discard(result_dir)
+        # Directories used by this run are never removed
+        referenced = [result_dir, previous_result_dir, getattr(config, 'reference_im_fn', None),
+                      getattr(config, 'mask_fn', None), mask if isinstance(mask, basestring) else None,
+                      self.runCache().directory]
+        referenced += [im_fns[i] for i in getattr(config, 'selection', []) if i < len(im_fns)]
+        # Placeholders read their file when they are displayed
+        for volumes in (self.resultVolumes, self.sparseVolumes):
+            if volumes:
+                referenced += volumes.filePaths()
+        self.resultStore().enforceAsync(keep=referenced)
         logger = logging.getLogger(__name__)
         logger.setLevel(logging.INFO)
         pyLAR.configure_logger(logger, config, configFile)
@@ -568,18 +1760,45 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
             slicer.util.saveNode(node, extra_image_file_name)
             config.selection.append(len(im_fns))
             im_fns.append(extra_image_file_name)
+        if mask is not None and not isinstance(mask, basestring):
+            mask_fn = os.path.join(result_dir, "Mask.nrrd")
+            if mask.IsA('vtkMRMLSegmentationNode'):
+                labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+                slicer.modules.segmentations.logic().ExportAllSegmentsToLabelmapNode(mask, labelmap)
+                slicer.util.saveNode(labelmap, mask_fn)
+                slicer.mrmlScene.RemoveNode(labelmap)
+            else:
+                slicer.util.saveNode(mask, mask_fn)
+            mask = mask_fn
+        if mask:
+            config.mask_fn = mask
         # Start actual process
         self.abort = False
-        self.thread = threading.Thread(target=self.thread_doit,
-                                       args=(self.thread_pyLAR, algo, config, software, im_fns, result_dir),
-                                       kwargs={'configFN': configFile, 'file_list_file_name': file_list_file_name})
+        self.profile_dir = result_dir if self.profiling or getattr(config, 'profile', False) else None
+        kwargs = {'configFN': configFile, 'file_list_file_name': file_list_file_name}
+        if algo == 'lr' and node and previous_result_dir:
+            args = (self.thread_incrementalLowRank, config, software, [extra_image_file_name], result_dir)
+            kwargs = {}
+        else:
+            if datafile:
+                downloads = self.loadJSONFile(datafile)
+                selected = set(os.path.basename(im_fns[i]) for i in config.selection)
+                positions = [i for i, name in enumerate(downloads['files'].keys()) if name in selected]
+                fetch = [(downloads, positions)] if positions else []
+            else:
+                fetch = self._missingInputs(im_fns, config.selection)
+            if fetch:
+                args = (self.thread_pipelinedPyLAR, fetch, algo, config, software, im_fns, result_dir)
+            else:
+                args = (self.thread_pyLAR, algo, config, software, im_fns, result_dir)
+        self.thread = threading.Thread(target=self.thread_doit, args=args, kwargs=kwargs)
 
         self.main_queue_start()
         self.post_queue_start()
         self.thread.start()
 
     def thread_pyLAR(self, algo, config, software, im_fns, result_dir,
-                         configFN, file_list_file_name):
+                         configFN, file_list_file_name, prepared=None):
         """ Run the actual pyLAR algorithm.
 
         Parameters
@@ -591,25 +1810,602 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         result_dir: Output directory. If it does not already exist, it will be created
         configFN: Optional configuration file name, to print more explicit log messages
         file_list_file_name: Optional file list file name, to print more explicit log messages.
+        prepared: Optional dictionary {real path of an input image: registered and preprocessed image} of
+                  the images prepared while they were downloaded (see 'thread_pipelinedPyLAR()').
 
         Returns
         -------
         This functions does not return any value by populates self.post_queue with the list of
         output files from pyLAR.run(). The list of files depends on the algorithm that is chosen.
+        If 'config.run_cache' is set and the same run was already computed, the outputs of the previous
+        run are reused (see 'RunCache').
+        For 'lr', if 'config.mask_fn' is set, the decomposition is restricted to the voxels inside the mask
+        and is computed in this module instead of pyLAR (see 'thread_maskedLowRank()').
+        For 'lr', if 'config.sparse_storage' is set, sparse components are stored with 'SparseImage'.
+        Input images are checked before anything else is done (see 'validateInputs()'). Then, images of the
+        cache directory are replaced by their uncompressed copy if it is enabled (see 'uncompressedCache()').
 
         """
-        pyLAR.run(algo, config, software, im_fns, result_dir,
-                  configFN=configFN, file_list_file_name=file_list_file_name)
+        self.validateInputs(algo, config, im_fns)
+        fingerprint = None
+        # The fingerprint is computed on the original images, whose hash is known once they are downloaded
+        if getattr(config, 'run_cache', False):
+            fingerprint = self.runCache().fingerprint(algo, config, im_fns, software)
+            outputs = self.runCache().materialize(fingerprint, result_dir)
+            if outputs is not None:
+                logging.info('Identical run found in cache. Reusing its outputs in %s' % result_dir)
+                if algo == 'lr':
+                    LowRankBasis.saveParameters(result_dir, config)
+                for i in outputs:
+                    self.post_queue.put((SparseImage.baseName(i), i))
+                pyLAR.close_handlers(logging.getLogger(__name__))
+                return
+        im_fns = self._uncompressedInputs(im_fns, getattr(config, 'selection', range(len(im_fns))))
+        user_config = config
+        work_dir = None
+        concurrency = None
+        try:
+            config, im_fns, work_dir = self._preprocessInputs(algo, config, software, im_fns, prepared)
+            # pyLAR does not report its progress: the amount of work is unknown
+            self.progress.begin('Running %s' % algo, 0)
+            if algo != 'lr' and getattr(config, 'memory_budget', None):
+                concurrency = ConcurrencyLimit(self.requiredSoftware(), config.memory_budget * 1048576)
+                config = self._limitConcurrency(concurrency, algo, config, im_fns)
+                concurrency.start()
+            if algo == 'lr' and getattr(config, 'mask_fn', None):
+                self.thread_maskedLowRank(config, software, im_fns, result_dir)
+            else:
+                pyLAR.run(algo, config, software, im_fns, result_dir,
+                          configFN=configFN, file_list_file_name=file_list_file_name)
+        finally:
+            if concurrency:
+                concurrency.stop()
+                if concurrency.peak_rss:
+                    self.toolPeakMemory[algo] = concurrency.peak_rss
+            if work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        if algo == 'lr' and getattr(config, 'sparse_storage', False):
+            self._compressSparseOutputs(result_dir)
+        if algo == 'lr':
+            LowRankBasis.saveParameters(result_dir, user_config)
+        if fingerprint:
+            self.runCache().store(fingerprint, result_dir)
         list_images = pyLAR.readTxtIntoList(os.path.join(result_dir, 'list_outputs.txt'))
+        for i in list_images:
+            self.post_queue.put((SparseImage.baseName(i), i))
+        logger = logging.getLogger(__name__)
+        pyLAR.close_handlers(logger)
+
+    def _runConfiguration(self, config):
+        """ Returns a copy of 'config' that can be modified for one run without modifying the configuration
+        given by the user.
+        """
+        run_config = type('config_obj', (object,), {})()
+        for name in dir(config):
+            if not name.startswith('__'):
+                setattr(run_config, name, getattr(config, name))
+        return run_config
+
+    def _limitConcurrency(self, concurrency, algo, config, im_fns):
+        """ Returns the configuration of the run, with 'number_of_cpu' lowered so that the tools pyLAR runs in
+        parallel fit in 'config.memory_budget'.
+
+        A 'number_of_cpu' set by the user is kept. Otherwise, 'number_of_cpu' is only set, in a copy of 'config',
+        when the budget allows fewer tools than the number of cores (pyLAR's default).
+        The peak memory of one tool is the largest one measured during the previous runs of 'algo', or is
+        estimated from the size of the reference image (see 'ConcurrencyLimit').
+        """
+        peak = self.toolPeakMemory.get(algo)
+        if not peak:
+            selection = getattr(config, 'selection', range(len(im_fns)))
+            header = InputValidator.header(getattr(config, 'reference_im_fn', None) or im_fns[selection[0]])
+            peak = concurrency.estimate(int(numpy.prod(header['size']))) if isinstance(header, dict) else 0
+        number_of_cpu = multiprocessing.cpu_count()
+        limited = concurrency.limit(number_of_cpu, peak)
+        if getattr(config, 'number_of_cpu', None):
+            if limited < config.number_of_cpu:
+                logging.warning('Memory budget of %.1f MB allows %d tools in parallel (%.1f MB per tool):'
+                                ' keeping number_of_cpu=%d set in the configuration'
+                                % (concurrency.memory_budget / 1048576.0, limited, peak / 1048576.0,
+                                   config.number_of_cpu))
+            return config
+        if limited < number_of_cpu:
+            logging.info('Memory budget of %.1f MB: running %d tools in parallel instead of %d (%.1f MB per tool)'
+                         % (concurrency.memory_budget / 1048576.0, limited, number_of_cpu, peak / 1048576.0))
+            config = self._runConfiguration(config)
+            config.number_of_cpu = limited
+        return config
+
+    def run_sweep(self, configFile, lamdas, sigmas=None):
+        """ Asynchronously runs the low-rank/sparse decomposition ('lr') of the images of a configuration file
+        for several values of 'lamda' (and optionally of 'sigma').
+
+        Registration is performed once (see '_registerInputs()'), and preprocessing once per value of 'sigma'
+        (see '_registerAndPreprocess()'). Each point is then decomposed by pyLAR ('pyLAR.run()') with
+        registration and preprocessing disabled. If the configuration contains 'mask_fn', the voxels inside the
+        mask are decomposed like in 'thread_maskedLowRank()', and each value of 'lamda' is warm-started from the
+        previous one (see 'MaskedLowRankDecomposition'). Values of 'sigma' are processed in parallel if
+        'threadpoolctl' is available to share the BLAS threads between them, and one at a time otherwise.
+        Outputs of each point are written in a sub-directory of 'result_dir', and a summary table of the rank,
+        sparsity and residual of each point is written in 'result_dir/sweep_summary.csv' (see 'thread_sweep()').
+
+        Parameters
+        ----------
+        configFile: 'lr' configuration file.
+        lamdas: list of values of 'lamda'.
+        sigmas: list of values of 'sigma'. Default: value in configuration file.
+        """
+        try:
+            if self.thread.is_alive():
+                logging.warning("Processing is already running")
+                return
+        except AttributeError:
+            pass
+        config = pyLAR.loadConfiguration(configFile, 'config')
+        pyLAR.containsRequirements(config, ['file_list_file_name', 'result_dir', 'selection'], configFile)
+        im_fns = pyLAR.readTxtIntoList(self._normalize_path(config.file_list_file_name))
+        if sigmas is None:
+            sigmas = [getattr(config, 'sigma', 0)]
+        self.abort = False
+        self.profile_dir = config.result_dir if self.profiling or getattr(config, 'profile', False) else None
+        self.thread = threading.Thread(target=self.thread_doit,
+                                       args=(self.thread_sweep, config, self.softwarePaths(), im_fns,
+                                             config.result_dir, lamdas, sigmas))
+        self.main_queue_start()
+        self.post_queue_start()
+        self.thread.start()
+
+    def thread_sweep(self, config, software, im_fns, result_dir, lamdas, sigmas):
+        """ Runs the decompositions of a parameter sweep (see 'run_sweep()').
+
+        Returns
+        -------
+        List of dictionaries (one per point) containing 'lamda', 'sigma', 'rank', 'sparsity', 'residual',
+        'time' and 'output_dir'.
+        """
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        self.validateInputs('lr', config, im_fns)
+        im_fns = self._uncompressedInputs(im_fns, config.selection)
+        selected = [im_fns[i] for i in config.selection]
+        names = [os.path.splitext(os.path.basename(f))[0] for f in selected]
+        registered = self._registerInputs(config, software, selected, os.path.join(result_dir, 'registered'))
+        lamdas = sorted(lamdas)
+        self.progress.begin('Parameter sweep', len(lamdas) * len(sigmas), 'decompositions')
+
+        def chain(sigma):
+            chain_config = self._runConfiguration(config)
+            chain_config.registration = 'none'
+            chain_config.sigma = sigma
+            preprocessed = self._registerAndPreprocess(chain_config, software, registered, result_dir,
+                                                       report_progress=False)
+            chain_config.histogram_matching = False
+            chain_config.sigma = 0
+            inputs = list(im_fns)
+            for i, preprocessed_fn in zip(config.selection, preprocessed):
+                inputs[i] = preprocessed_fn
+            decomposition = self._maskedDecomposition(chain_config, preprocessed) \
+                if getattr(config, 'mask_fn', None) else None
+            rows = []
+            result = None
+            for lamda in lamdas:
+                if self.abort:
+                    raise Exception("Processing aborted")
+                output_dir = os.path.join(result_dir, 'lamda_%g_sigma_%g' % (lamda, sigma))
+                point_config = self._runConfiguration(chain_config)
+                point_config.lamda = lamda
+                point_config.result_dir = output_dir
+                start_time = time()
+                if decomposition:
+                    result = decomposition.decompose(lamda, start=result)
+                    decomposition.writeImages(result, output_dir, names)
+                    statistics = result
+                else:
+                    pyLAR.run('lr', point_config, software, inputs, output_dir)
+                    statistics = self._decompositionStatistics(preprocessed, output_dir)
+                rows.append({'lamda': lamda, 'sigma': sigma, 'rank': statistics['rank'],
+                             'sparsity': statistics['sparsity'], 'residual': statistics['residual'],
+                             'time': time() - start_time, 'output_dir': output_dir})
+                self.progress.advance(detail='lamda %g, sigma %g' % (lamda, sigma))
+            return rows
+
+        # Chains run in parallel share the cores: without 'threadpoolctl', each chain would start one BLAS thread
+        # per core, so they are run one at a time.
+        cores = self.threadPlanner.topology()['physical']
+        chains = min(len(sigmas), cores) if threadpoolctl else 1
+        limits = threadpoolctl.threadpool_limits(max(1, cores // chains), user_api='blas') if chains > 1 else None
+        pool = ThreadPool(chains)
+        try:
+            rows = [row for rows in pool.map(chain, sigmas) for row in rows]
+        finally:
+            pool.close()
+            pool.join()
+            if limits:
+                limits.restore_original_limits()
+        columns = ['lamda', 'sigma', 'rank', 'sparsity', 'residual', 'time', 'output_dir']
+        with open(os.path.join(result_dir, 'sweep_summary.csv'), 'w') as f:
+            f.write(','.join(columns) + '\n')
+            for row in rows:
+                f.write(','.join([str(row[c]) for c in columns]) + '\n')
+        for row in rows:
+            logging.info('lamda=%(lamda)g sigma=%(sigma)g: rank %(rank)d, sparsity %(sparsity).3f, '
+                         'residual %(residual).2e, %(time).1f s' % row)
+        return rows
+
+    def _decompositionStatistics(self, im_fns, output_dir, tolerance=1e-3):
+        """ Returns the 'rank', 'sparsity' and 'residual' of the 'lr' decomposition of the images 'im_fns' written
+        in 'output_dir'.
+
+        'list_outputs.txt' lists the low-rank images (L) followed by the sparse images (S). The rank is the
+        number of singular values of L larger than 'tolerance' times the largest one, the sparsity is the
+        fraction of non-zero voxels of S, and the residual is ||D - L - S|| / ||D||, D being the input images.
+        """
+        outputs = pyLAR.readTxtIntoList(os.path.join(output_dir, 'list_outputs.txt'))
+        number_of_images = len(outputs) // 2
+        reference = sitk.ReadImage(outputs[0])
+
+        def matrix(filenames):
+            return numpy.column_stack([LowRankBasis._vector(sitk.ReadImage(f), reference) for f in filenames])
+
+        L = matrix(outputs[:number_of_images])
+        S = matrix(outputs[number_of_images:])
+        D = matrix(im_fns)
+        singular_values = numpy.linalg.svd(L, compute_uv=False)
+        d_norm = numpy.linalg.norm(D)
+        return {'rank': int(numpy.sum(singular_values > tolerance * singular_values[0])),
+                'sparsity': float(numpy.count_nonzero(S)) / S.size,
+                'residual': float(numpy.linalg.norm(D - L - S) / d_norm) if d_norm else 0.0}
+
+    def validateInputs(self, algo, config, im_fns):
+        """ Checks the headers of the selected input images and raises an exception listing all the problems found.
+
+        Images must match the geometry of 'config.reference_im_fn' only for 'lr' without registration,
+        since they are registered to the reference image otherwise (see 'InputValidator').
+        The header of 'config.mask_fn' is checked too. The mask is resampled on the grid of the reference image,
+        so it only needs to have the same dimension.
+        """
+        start_time = time()
+        selection = getattr(config, 'selection', range(len(im_fns)))
+        problems = [('selection', 'item %d is not in the list of %d images' % (i, len(im_fns)))
+                    for i in selection if i >= len(im_fns)]
+        selected = [im_fns[i] for i in selection if i < len(im_fns)]
+        same_grid = algo == 'lr' and getattr(config, 'registration', 'none') == 'none'
+        reference_fn = getattr(config, 'reference_im_fn', None) or (selected[0] if selected else None)
+        if reference_fn:
+            problems += InputValidator(reference_fn, same_grid,
+                                       self.threadPlanner.topology()['logical']).validate(selected)
+            mask_fn = getattr(config, 'mask_fn', None)
+            if algo == 'lr' and mask_fn:
+                problems += [(filename, 'mask: ' + problem) for filename, problem
+                             in InputValidator(reference_fn).validate([mask_fn]) if filename == mask_fn]
+        if problems:
+            raise Exception('%d problem(s) found in the input images:\n%s'
+                            % (len(problems), '\n'.join('%s: %s' % problem for problem in problems)))
+        logging.info('Headers of %d input images checked in %.2f s' % (len(selected), time() - start_time))
+
+    def _compressSparseOutputs(self, result_dir):
+        """ Replaces the sparse components listed in 'result_dir/list_outputs.txt' by their compact version
+        (see 'SparseImage') and updates 'list_outputs.txt'.
+        """
+        list_outputs_fn = os.path.join(result_dir, 'list_outputs.txt')
+        outputs = pyLAR.readTxtIntoList(list_outputs_fn)
+        sparse = [i for i, f in enumerate(outputs) if SparseImage.sparse_pattern.search(os.path.basename(f))
+                  and not SparseImage.isSparse(f)]
+        self.progress.begin('Compressing', len(sparse), 'images')
+        dense_size = 0
+        sparse_size = 0
+        for i in sparse:
+            dense_size += os.path.getsize(outputs[i])
+            outputs[i] = SparseImage.compress(outputs[i])
+            sparse_size += os.path.getsize(outputs[i])
+            self.progress.advance(detail=os.path.basename(outputs[i]))
+        pyLAR.writeTxtFromList(list_outputs_fn, outputs)
+        if sparse:
+            logging.info('Sparse components stored in %.1f MB instead of %.1f MB'
+                         % (sparse_size / 1048576.0, dense_size / 1048576.0))
+
+    def thread_maskedLowRank(self, config, software, im_fns, result_dir):
+        """ Low-rank/sparse decomposition ('lr') of the voxels inside 'config.mask_fn'.
+
+        Selected images are registered and preprocessed in the same order as pyLAR (see
+        '_registerAndPreprocess()'), then only the voxels inside the mask are stacked in the data matrix
+        (see 'MaskedLowRankDecomposition'). The mask is resampled on the grid of the reference image. Low-rank
+        and sparse images are written in 'result_dir' and listed in 'list_outputs.txt'.
+        """
+        if not os.path.isdir(result_dir):
+            os.makedirs(result_dir)
+        selected = [im_fns[i] for i in config.selection]
+        names = [os.path.splitext(os.path.basename(f))[0] for f in selected]
+        registered = self._registerAndPreprocess(config, software, selected, result_dir)
+        if self.abort:
+            raise Exception("Processing aborted")
+        self.progress.begin('Decomposing', 1, 'step')
+        decomposition = self._maskedDecomposition(config, registered)
+        result = decomposition.decompose(config.lamda)
+        logging.info('Rank %(rank)d, sparsity %(sparsity).3f, residual %(residual).2e, %(iterations)d iterations'
+                     % result)
+        decomposition.writeImages(result, result_dir, names)
+
+    def _maskedDecomposition(self, config, im_fns):
+        """ Returns the decomposition of the voxels of the registered and preprocessed images 'im_fns' that are
+        inside 'config.mask_fn' (see 'thread_maskedLowRank()').
+        """
+        reference = sitk.ReadImage(getattr(config, 'reference_im_fn', None) or im_fns[0])
+        mask = sitk.Resample(sitk.ReadImage(config.mask_fn), reference, sitk.Transform(),
+                             sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+        decomposition = MaskedLowRankDecomposition([sitk.ReadImage(f) for f in im_fns], mask=mask)
+        logging.info('Decomposing %d voxels inside the mask (%d voxels per image)'
+                     % (decomposition.data.shape[0], decomposition.reference.GetNumberOfPixels()))
+        return decomposition
+
+    def _registerAndPreprocess(self, config, software, im_fns, output_dir, report_progress=True):
+        """ Registers images to 'config.reference_im_fn' (see '_registerInputs()'), then applies histogram
+        matching and smoothing to the registered images, in the same order as pyLAR.
+
+        Preprocessed images are kept in the preprocessing cache if 'config.preprocessing_cache' is set, and in
+        'output_dir/preprocessed' otherwise. Progress is reported if 'report_progress' is True.
+
+        Returns
+        -------
+        List of registered and preprocessed images.
+        """
+        registered = self._registerInputs(config, software, im_fns, os.path.join(output_dir, 'registered'),
+                                          report_progress)
+        histogram_matching = getattr(config, 'histogram_matching', False)
+        sigma = getattr(config, 'sigma', 0)
+        if not (histogram_matching or sigma):
+            return registered
+        if getattr(config, 'preprocessing_cache', 0):
+            cache = self.preprocessingCache()
+            cache.max_size = config.preprocessing_cache * 1048576
+        else:
+            cache = PreprocessingCache(os.path.join(output_dir, 'preprocessed'), max_size=float('inf'))
+        preprocessed = []
+        if report_progress:
+            self.progress.begin('Preprocessing', len(registered), 'images')
+        for f in registered:
+            if self.abort:
+                raise Exception("Processing aborted")
+            preprocessed.append(cache.preprocess(f, config.reference_im_fn, histogram_matching, sigma))
+            if report_progress:
+                self.progress.advance(detail=os.path.basename(f))
+        return preprocessed
+
+    def _registerInputs(self, config, software, im_fns, output_dir, report_progress=True):
+        """ Registers images to 'config.reference_im_fn' with BRAINSFit according to 'config.registration'
+        ('none', 'rigid' or 'affine'), running several registrations in parallel. If 'report_progress' is True,
+        progress is reported as each registration completes.
+
+        Returns
+        -------
+        List of registered images.
+        """
+        registration = getattr(config, 'registration', 'none')
+        if registration == 'none':
+            return list(im_fns)
+        transform_types = {'rigid': 'Rigid', 'affine': 'Rigid,ScaleVersor3D,ScaleSkewVersor3D,Affine'}
+        if registration not in transform_types:
+            raise Exception("Unknown registration type: %s" % registration)
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        processes, threads = self.threadPlanner.plan('BRAINSFit', len(im_fns), getattr(config, 'number_of_cpu', None),
+                                                     getattr(config, 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', None))
+        env = dict(os.environ)
+        env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+
+        def register(item):
+            i, im_fn = item
+            output = os.path.join(output_dir, os.path.splitext(os.path.basename(im_fn))[0] + '.nrrd')
+            command = [software.EXE_BRAINSFit, '--fixedVolume', config.reference_im_fn, '--movingVolume', im_fn,
+                       '--outputVolume', output, '--transformType', transform_types[registration],
+                       '--initializeTransformMode', 'useMomentsAlign']
+            if WorkerProfiler.call(command, env=env):
+                raise Exception('Registration failed: %s' % ' '.join(command))
+            return i, output
+
+        registered = [None] * len(im_fns)
+        if report_progress:
+            self.progress.begin('Registering', len(im_fns), 'images')
+        pool = ThreadPool(processes)
+        try:
+            for i, output in pool.imap_unordered(register, enumerate(im_fns)):
+                registered[i] = output
+                if report_progress:
+                    self.progress.advance(detail=os.path.basename(im_fns[i]))
+            return registered
+        finally:
+            pool.close()
+            pool.join()
+
+    def thread_incrementalLowRank(self, config, software, im_fns, result_dir):
+        """ Decomposes new images using the low-rank basis of the previous 'lr' run 'config.previous_result_dir'.
+
+        New images are registered and preprocessed like the images of the previous run, with the parameters
+        recorded in its result directory (see 'LowRankBasis.saveParameters()'), or with the parameters of
+        'config' if the previous result directory does not contain them.
+
+        Parameters
+        ----------
+        config: configuration object containing 'previous_result_dir'.
+        software: software configuration object
+        im_fns: List of the images to decompose.
+        result_dir: Output directory. Low-rank and sparse images are written in this directory
+                    and listed in 'list_outputs.txt'.
+        """
+        run_config = self._runConfiguration(config)
+        parameters = LowRankBasis.loadParameters(config.previous_result_dir) or {}
+        for name in ['reference_im_fn', 'registration', 'histogram_matching', 'sigma']:
+            if name in parameters:
+                value = parameters[name]
+                setattr(run_config, name, str(value) if isinstance(value, basestring) else value)
+        registered = self._registerAndPreprocess(run_config, software, im_fns, result_dir)
+        self.progress.begin('Decomposing', len(im_fns), 'images')
+        basis = LowRankBasis.fromResultDir(config.previous_result_dir)
+        low_rank_fns = []
+        sparse_fns = []
+        for im_fn, registered_fn in zip(im_fns, registered):
+            name = os.path.splitext(os.path.basename(im_fn))[0]
+            low_rank_fns.append(os.path.join(result_dir, name + '_LowRank.nrrd'))
+            sparse_fns.append(os.path.join(result_dir, name + '_Sparse.nrrd'))
+            basis.decompose(registered_fn, low_rank_fns[-1], sparse_fns[-1])
+            self.progress.advance(detail=name)
+        list_images = low_rank_fns + sparse_fns
+        pyLAR.writeTxtFromList(os.path.join(result_dir, 'list_outputs.txt'), list_images)
         for i in list_images:
             name = os.path.splitext(os.path.basename(i))[0]
             self.post_queue.put((name, i))
         logger = logging.getLogger(__name__)
         pyLAR.close_handlers(logger)
 
+    def _preprocessInputs(self, algo, config, software, im_fns, prepared=None):
+        """ Registers and preprocesses (histogram matching and smoothing) the inputs of 'lr' using the preprocessing
+        cache, or uses the images prepared while they were downloaded.
+
+        If all the selected images are in 'prepared' (see '_prepareInput()'), or if 'config.preprocessing_cache'
+        is set, the selected images are replaced by their registered and preprocessed version (see
+        '_registerAndPreprocess()'). pyLAR is then run with registration and preprocessing disabled in a copy of
+        'config'. Registered images are written in a temporary directory, outside of 'result_dir', which the
+        caller removes after the run. Masked decompositions preprocess the registered images themselves (see
+        'thread_maskedLowRank()').
+
+        Returns
+        -------
+        (config, im_fns, work_dir): configuration and list of images to process, and temporary directory
+        (None if the inputs are used as they are).
+        """
+        selected = [im_fns[i] for i in config.selection]
+        work_dir = None
+        if prepared and self._preparesInputs(algo, config) \
+                and all(os.path.realpath(f) in prepared for f in selected):
+            preprocessed = [prepared[os.path.realpath(f)] for f in selected]
+        else:
+            preprocessing = getattr(config, 'histogram_matching', False) or getattr(config, 'sigma', 0)
+            if not (self._preparesInputs(algo, config) and getattr(config, 'preprocessing_cache', 0)
+                    and preprocessing):
+                return config, im_fns, None
+            work_dir = tempfile.mkdtemp(prefix='pyLARInputs', dir=slicer.app.temporaryPath)
+            try:
+                preprocessed = self._registerAndPreprocess(config, software, selected, work_dir)
+            except Exception:
+                shutil.rmtree(work_dir, ignore_errors=True)
+                raise
+        im_fns = list(im_fns)
+        for i, preprocessed_fn in zip(config.selection, preprocessed):
+            im_fns[i] = preprocessed_fn
+        config = self._runConfiguration(config)
+        config.registration = 'none'
+        config.histogram_matching = False
+        config.sigma = 0
+        return config, im_fns, work_dir
+
+    def _preparesInputs(self, algo, config):
+        """ Returns True if the inputs of the run can be registered and preprocessed by this module before pyLAR
+        is run (see '_preprocessInputs()').
+        """
+        return bool(algo == 'lr' and not getattr(config, 'mask_fn', None)
+                    and (getattr(config, 'registration', 'none') != 'none'
+                         or getattr(config, 'histogram_matching', False) or getattr(config, 'sigma', 0)))
+
+    def _missingInputs(self, im_fns, selection):
+        """ Finds the selected images that are missing from the cache directory but can be downloaded.
+
+        Returns
+        -------
+        List of (downloads, selection) pairs that can be passed to 'thread_downloadData()'.
+        """
+        cache_dir = self._normalize_path(slicer.app.settings().value('Cache/Path'))
+        missing = [os.path.basename(im_fns[i]) for i in selection
+                   if not os.path.isfile(im_fns[i])
+                   and self._normalize_path(os.path.dirname(im_fns[i])) == cache_dir]
+        positions = collections.OrderedDict()
+        found = set()
+        for entry in self.registry.query(names=missing):
+            if entry.name not in found:
+                found.add(entry.name)
+                positions.setdefault(entry.manifest, []).append(entry.position)
+        return [(self.loadJSONFile(manifest), selected) for manifest, selected in positions.items()]
+
+    def thread_pipelinedPyLAR(self, fetch, algo, config, software, im_fns, result_dir,
+                              configFN, file_list_file_name):
+        """ Downloads the selected input images and runs pyLAR as soon as they are available.
+
+        Downloading is done in a separate thread that passes each verified file through a queue. While the
+        other files are downloaded, each received image is registered and preprocessed (see '_prepareInput()'),
+        as soon as the reference image is available. pyLAR is started once all the files to fetch have been
+        received, on the prepared images.
+
+        Parameters
+        ----------
+        fetch: list of (downloads, selection) pairs passed to 'thread_downloadData()'.
+        Other parameters: see 'thread_pyLAR()'.
+        """
+        required = set()
+        for downloads, selection in fetch:
+            names = downloads['files'].keys()
+            required.update(names[i] for i in selection)
+        ready = Queue.Queue()
+
+        def download():
+            try:
+                for downloads, selection in fetch:
+                    self.thread_downloadData(downloads, selection,
+                                             on_file=lambda name, filePath: ready.put((name, filePath)))
+            except Exception as e:
+                ready.put(e)
+
+        work_dir = tempfile.mkdtemp(prefix='pyLARInputs', dir=slicer.app.temporaryPath)
+        prepared = {}
+        waiting = []
+        downloader = threading.Thread(target=download)
+        downloader.start()
+        try:
+            try:
+                missing = set(required)
+                while missing:
+                    item = ready.get()
+                    if isinstance(item, Exception):
+                        raise item
+                    name, filePath = item
+                    waiting.append(filePath)
+                    missing.discard(name)
+                    reference_im_fn = getattr(config, 'reference_im_fn', None)
+                    if not self._preparesInputs(algo, config) or not (reference_im_fn
+                                                                      and os.path.isfile(reference_im_fn)):
+                        continue
+                    for filename in waiting:
+                        prepared[os.path.realpath(filename)] = self._prepareInput(config, software, filename,
+                                                                                  work_dir)
+                    waiting = []
+            except Exception:
+                self.abort = True
+                raise
+            finally:
+                downloader.join()
+            logging.info('Selected images available. Starting pyLAR.')
+            self.thread_pyLAR(algo, config, software, im_fns, result_dir,
+                              configFN=configFN, file_list_file_name=file_list_file_name, prepared=prepared)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _prepareInput(self, config, software, filename, work_dir):
+        """ Registers and preprocesses one input image of 'lr' in 'work_dir', like '_preprocessInputs()' does, so
+        that it is done while the other input images are downloaded (see 'thread_pipelinedPyLAR()').
+
+        Returns
+        -------
+        Registered and preprocessed image.
+        """
+        if self.abort:
+            raise Exception("Processing aborted")
+        # Progress reports the download, which continues meanwhile
+        return self._registerAndPreprocess(config, software, [filename], work_dir, report_progress=False)[0]
+
     def loadJSONFile(self, filename):
         """ Reads a JSON file into a dictionary.
 
+         The file is read through the dataset registry, so it is only parsed once. The 'files'
+         dictionary preserves the order of the JSON file.
+
          Parameters
          ----------
          filename: file containing JSON structure.
@@ -619,24 +2415,51 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
          Dictionary with file content
 
     """
-        file_path = os.path.realpath(__file__)
-        dir_path = os.path.dirname(file_path)
-        dir_path = os.path.join(dir_path, 'Data')
-        data = open(os.path.join(dir_path, filename), 'r').read()
-        return json.loads(data)
+        return self.registry.load(filename)
+
+    def selectData(self, filename, names=None, subjects=None, modality=None):
+        """ Returns the selection of files in a JSON file that match the given criteria.
+
+        Example: selectData('HealthyVolunteers-T1-MPRage.json', subjects=range(10, 41))
+
+        Parameters
+        ----------
+        filename: JSON file containing image information.
+        names: list of file names.
+        subjects: list of subject IDs.
+        modality: modality name (e.g. 'T1-MPRage').
 
-    def thread_downloadData(self, downloads, selection=None):
+        Returns
+        -------
+        List of integers that can be passed as 'selection' to 'thread_downloadData()' and
+        'createExampleConfigurationAndListFiles()'.
+        """
+        return self.registry.selection(filename, names=names, subjects=subjects, modality=modality)
+
+    def thread_downloadData(self, downloads, selection=None, on_file=None):
         """ Downloads data based on the information provided in filename (JSON).
 
-        JSON must contain a key called 'url' and a key called 'files'. See example files in 'Data' directory.
+        JSON must contain a key called 'url' and/or a key called 'mirrors' (list of URLs), and a key called 'files'.
+        See example files in 'Data' directory. Additional mirrors can be listed in the application setting
+        'LowRankImageDecomposition/Mirrors' and are tried first (see 'MirrorSelector').
+        Each file is downloaded from the fastest mirror. If the download fails or if the md5 sum of the
+        downloaded file is wrong, the next mirror is used.
+        JSON can also contain a key called 'archive': the URL of a tar archive (optionally compressed)
+        bundling the files, or its item ID on the mirrors. The archive is downloaded once and extracted
+        while it is streamed. Files missing from the archive, or with a wrong md5 sum, are downloaded
+        individually.
         File name of the images that are downloaded are inserted in post_queue. If 'post_queue' is started,
         images will be asynchronously loaded in Slicer.
+        If the uncompressed cache is enabled (see 'uncompressedCache()'), an uncompressed copy of each verified
+        compressed image is written, and the copy is inserted in post_queue instead of the original file.
 
         Parameters
         ----------
         filename: file containing JSON structure.
         selection: list of integers. Only files that are selected will be downloaded. If no selection is
                    provided, all files will be downloaded.
+        on_file: Optional callable called with (name, filePath) for each verified file, instead of
+                 inserting the file in post_queue.
         """
         logging.info('Starting to download')
         logging.debug("downloads:" + str(downloads))
@@ -649,40 +2472,192 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
             if max(selection) > len(downloads['files'].keys())-1:
                 raise Exception("'selection' contains items (%d) greater than the number of files available in %r"
                                 % (max(selection), downloads))
-        import urllib
-        if 'url' not in downloads.keys():
+        mirrors = list(slicer.app.settings().value('LowRankImageDecomposition/Mirrors') or [])
+        if isinstance(mirrors, basestring):
+            mirrors = [mirrors]
+        mirrors += downloads.get('mirrors', [])
+        if 'url' in downloads.keys():
+            mirrors.append(downloads['url'])
+        if not mirrors and 'archive' not in downloads.keys():
             raise Exception("Key 'url' is missing in dictionary")
-        url = downloads['url']
         if 'files' not in downloads.keys():
             raise Exception("Key 'files' is missing in dictionary")
-        for name, value in [downloads['files'].items()[i] for i in selection]:
+        items = downloads['files'].items()
+        selector = MirrorSelector(mirrors)
+        self._ingest = self.uncompressedCache()
+        self.progress.begin('Downloading', len(selection), 'files')
+        count = 0
+        pending = collections.OrderedDict()
+        for name, value in [items[i] for i in selection]:
+            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+            if os.path.exists(filePath) \
+                    and slicer.app.settings().value('Cache/ForceRedownload') == 'false' \
+                    and os.stat(filePath).st_size != 0:
+                md5 = self._md5sum(filePath)
+                if md5 == value[1]:
+                    self._rememberHash(filePath, md5)
+                    count += 1
+                    self.progress.update(count, detail=name)
+                    self._downloaded(name, filePath, on_file)
+                    continue
+                logging.warning("%s md5 sum does not match expected value. Got %s. Expected %s. Downloading again."
+                                % (filePath, md5, value[1]))
+            pending[name] = (value, filePath)
+        if pending and 'archive' in downloads.keys():
+            for name, filePath in self._extractArchive(downloads['archive'], selector, pending):
+                del pending[name]
+                count += 1
+                self.progress.update(count, detail=name)
+                self._downloaded(name, filePath, on_file)
+        if pending and not mirrors:
+            raise Exception("Files missing from archive and key 'url' is missing in dictionary: %s"
+                            % ', '.join(pending.keys()))
+        for index, (name, (value, filePath)) in enumerate(pending.items()):
             if self.abort:
                 raise Exception("Download aborted")
-            item_url = url + value[0]
-            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
-            if not os.path.exists(filePath) \
-                    or slicer.app.settings().value('Cache/ForceRedownload') != 'false' \
-                    or os.stat(filePath).st_size == 0:
-                logging.info('Requesting download %s\nfrom %s...\n' % (filePath, item_url))
-                urllib.urlretrieve(item_url, filePath)
-            m = hashlib.md5()
-            with open(filePath, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    m.update(chunk)
-            if m.hexdigest() != value[1]:
-                raise Exception("%s md5 sum does not match expected value. Got %s. Expected %s. Try to remove \
-                                downloaded file and donwload again."
-                                %(filePath,str(m.hexdigest()),str(value[1])))
-            self.post_queue.put((name, filePath))
+            if index == 0:
+                selector.probe(name, value[0])
+            self._downloadFile(selector, name, value, filePath, count)
+            count += 1
+            self.progress.update(count, detail=name)
+            self._downloaded(name, filePath, on_file)
+        if self._ingest:
+            self._ingest.evict(keep=[self._ingest.path(name) for name, value in [items[i] for i in selection]])
         logging.info('Finished with download')
         return downloads
 
+    def _extractArchive(self, archive, selector, pending):
+        """ Streams a tar archive and extracts the files listed in 'pending' while it is downloaded.
+
+        Members are matched by file name, regardless of the directory they are stored in within the
+        archive. Each extracted file is yielded as (name, filePath) as soon as its md5 sum is verified,
+        so that it can be loaded while the rest of the archive is downloaded. Files with a wrong md5 sum
+        are removed. If the archive cannot be downloaded, the files are downloaded individually instead.
+
+        Parameters
+        ----------
+        archive: URL of the archive, or its item ID on the mirrors.
+        selector: MirrorSelector used to build the archive URL if 'archive' is not a URL.
+        pending: dictionary {name: ((item, md5), filePath)} of the files to extract.
+        """
+        import urllib2
+        import socket
+        if '://' in archive:
+            urls = [archive]
+        else:
+            urls = [selector.url(mirror, archive, archive) for mirror in selector.ordered()]
+        for url in urls:
+            logging.info('Requesting archive %s...' % url)
+            start_time = time()
+            size = 0
+            try:
+                response = urllib2.urlopen(url)
+                stream = tarfile.open(fileobj=response, mode='r|*')
+            except Exception as e:
+                logging.warning('Could not download archive %s: %s' % (url, e))
+                continue
+            try:
+                for member in stream:
+                    if self.abort:
+                        raise Exception("Download aborted")
+                    name = os.path.basename(member.name)
+                    if not member.isfile() or name not in pending:
+                        continue
+                    value, filePath = pending[name]
+                    m = hashlib.md5()
+                    source = stream.extractfile(member)
+                    with open(filePath, 'wb') as f:
+                        for chunk in iter(lambda: source.read(1048576), b""):
+                            m.update(chunk)
+                            f.write(chunk)
+                    size += member.size
+                    if m.hexdigest() != value[1]:
+                        logging.warning("%s md5 sum in archive does not match expected value. Got %s. Expected %s."
+                                        % (name, m.hexdigest(), value[1]))
+                        os.remove(filePath)
+                        continue
+                    self._rememberHash(filePath, m.hexdigest())
+                    yield name, filePath
+            except (tarfile.TarError, IOError, socket.error) as e:
+                # Files that were not extracted yet are still pending and are downloaded individually
+                logging.warning('Could not extract archive %s: %s' % (url, e))
+            finally:
+                stream.close()
+                response.close()
+            elapsed = max(time() - start_time, 1e-6)
+            logging.info('Extracted %.1f MB from %s in %.1f s (%.2f MB/s)'
+                         % (size / 1048576.0, url, elapsed, size / 1048576.0 / elapsed))
+            return
+
+    def _downloadFile(self, selector, name, value, filePath, count):
+        """ Downloads one file from the fastest mirror, trying the other mirrors if the download fails
+        or if the md5 sum of the file does not match the expected value.
+        """
+        import urllib
+
+        def report(block_count, block_size, total_size):
+            if total_size > 0:
+                fraction = min(1.0, float(block_count * block_size) / total_size)
+                self.progress.update(count + fraction, detail=name)
+
+        errors = []
+        for mirror in selector.ordered():
+            if self.abort:
+                raise Exception("Download aborted")
+            item_url = selector.url(mirror, name, value[0])
+            logging.info('Requesting download %s\nfrom %s...\n' % (filePath, item_url))
+            start_time = time()
+            try:
+                urllib.urlretrieve(item_url, filePath, reporthook=report)
+            except Exception as e:
+                selector.failed(mirror)
+                errors.append('%s: %s' % (item_url, e))
+                continue
+            elapsed = max(time() - start_time, 1e-6)
+            md5 = self._md5sum(filePath)
+            if md5 != value[1]:
+                selector.failed(mirror)
+                errors.append('%s: md5 sum does not match expected value. Got %s. Expected %s.'
+                              % (item_url, md5, value[1]))
+                continue
+            self._rememberHash(filePath, md5)
+            size = os.path.getsize(filePath)
+            selector.succeeded(mirror, size, elapsed)
+            logging.info('Downloaded %s: %.1f MB in %.1f s (%.2f MB/s)'
+                         % (name, size / 1048576.0, elapsed, size / 1048576.0 / elapsed))
+            return
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        raise Exception("%s could not be downloaded from any mirror:\n%s" % (name, '\n'.join(errors)))
+
+    def _rememberHash(self, filePath, md5):
+        """ Records the md5 sum verified after a download, so that the run cache does not hash the file again.
+        """
+        self.preprocessingCache().rememberHash(filePath, md5)
+
+    def _md5sum(self, filePath):
+        m = hashlib.md5()
+        with open(filePath, "rb") as f:
+            for chunk in iter(lambda: f.read(4096), b""):
+                m.update(chunk)
+        return m.hexdigest()
+
+    def _downloaded(self, name, filePath, on_file):
+        if self._ingest:
+            filePath = self._ingest.get(filePath)
+        if on_file:
+            on_file(name, filePath)
+        else:
+            self.post_queue.put((name, filePath))
+
     def run_downloadData(self, filename):
         """ Asynchronously download data and load it in Slicer.
 
         If there is not already a thread running, either to download images, or to run
         the pyLAR processing, a new thread is started to asynchronously download data.
         Data is downloaded in 'main_queue' and loaded in Slicer in 'post_queue'.
+        If 'profiling' is set, the download is profiled and the profile is saved in the 'profiles'
+        sub-directory of Slicer's temporary directory.
 
         Parameters
         ----------
@@ -697,6 +2672,7 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
             pass
         data_dict = self.loadJSONFile(filename)
         self.abort = False
+        self.profile_dir = os.path.join(slicer.app.temporaryPath, 'profiles') if self.profiling else None
         self.thread = threading.Thread(target=self.thread_doit,
                                        args=(self.thread_downloadData, data_dict))
         self.main_queue_start()
@@ -713,14 +2689,15 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         filename: output file name.
         datafile: JSON file containing image information.
         algo: algorithm to create the configuration file for ('lr', 'uab', 'nglra')
-        download: boolean to download data or not.
+        download: boolean to download data or not. Only the selected images are downloaded.
+                  If False, the selected images are downloaded when 'run_pyLAR()' is called.
         selection: selection passed to 'createConfiguration()'
         output_dir: output_dir passed to 'createConfiguration()'
         registration: registration passed to 'createConfiguration()'
         """
         data_dict = self.loadJSONFile(datafile)
         if download:
-            data_dict = self.thread_downloadData(data_dict)
+            data_dict = self.thread_downloadData(data_dict, selection)
         data_list = data_dict['files'].keys()
         cache_dir = self._normalize_path(slicer.app.settings().value('Cache/Path'))
         data_list_path = []
@@ -743,7 +2720,10 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
                                 result_dir=None, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=None, clean=True,
                                 registration='affine', histogram_matching=False, sigma=0, num_of_iterations_per_level=4,
                                 num_of_levels=1, number_of_cpu=None,
-                                ants_params=None, use_healthy_atlas=False, registration_type='ANTS'):
+                                ants_params=None, use_healthy_atlas=False, registration_type='ANTS',
+                                memory_budget=None, preprocessing_cache=0, previous_result_dir=None,
+                                run_cache=False, mask_fn=None, sparse_storage=False, profile=False,
+                                plan_threads=False):
         """ Writes configuration file for pyLAR
 
         Parameters
@@ -755,14 +2735,31 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         lamda: float value
         verbose: boolean
         result_dir: output folder containing processing result. Default: slicer.app.temporaryPath+'/output'
-        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS: Number of threads used by tools based on ITK
+        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS: Number of threads used by tools based on ITK.
+        plan_threads: boolean specifying if 'number_of_cpu' and 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', when they
+                      are not given, are chosen together so that the tools use each physical core once
+                      (see 'ThreadPlanner'). Otherwise, only the given values are written in the configuration.
         clean: boolean specifying if result_dir is removed before new computation is run.
+        run_cache: boolean specifying if the outputs of an identical previous run are reused (see 'RunCache').
+                   Disabled by default: the content of the input images is hashed before each run, which takes
+                   time on large cohorts when no identical run is found.
+        profile: boolean specifying if the processing is profiled (see 'WorkerProfiler').
         registration: Type of registration ('none', 'rigid', 'affine'). Only for 'lr'.
         histogram_matching: boolean. Only for 'lr'.
         sigma: Smoothing kernel size. For 'lr' and 'nglra'.
+        preprocessing_cache: Maximum size (in MB) of the cache of preprocessed images (histogram matching and
+                             smoothing), or 0 to disable it (default). When it is enabled, inputs are registered
+                             and preprocessed by this module, in the same order as pyLAR. For 'lr'.
+        previous_result_dir: Result directory of a previous run. If set, an image given as a node to 'run_pyLAR()'
+                             is decomposed using the low-rank basis of that run instead of running the
+                             decomposition on all the images. For 'lr'.
+        mask_fn: Mask image. If set, only the voxels inside the mask are decomposed. For 'lr'.
+        sparse_storage: boolean specifying if sparse components are stored in a compact format that only contains
+                        their non-zero voxels (see 'SparseImage'). For 'lr'.
         num_of_iterations_per_level: integer. For 'uab' and 'nglra'.
         num_of_levels: integer. For 'uab' and 'nglra'.
-        number_of_cpu: Number of tools run in parallel. For 'uab' and 'nglra'.
+        number_of_cpu: Number of tools run in parallel. For 'uab' and 'nglra', and for the registrations of the
+                       inputs of 'lr'.
         ants_params: Parameters used for ANTS. For 'uab' and 'nglra'.
                     Default: ants_params = {'Convergence': '[100x50x25,1e-6,10]', \
                                'Dimension': 3, \
@@ -772,6 +2769,9 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
                                'Metric': 'MeanSquares[fixedIm,movingIm,1,0]'}
         use_healthy_atlas: boolean. For 'nglra'
         registration_type: Registration used: 'BSpline', 'Demons', 'ANTS'. For 'nglra'.
+        memory_budget: Maximum memory (in MB) used by the tools run in parallel. If 'number_of_cpu' is not
+                       set, it is lowered before the run so that the expected memory of the tools fits in the
+                       budget (see 'ConcurrencyLimit'). For 'uab' and 'nglra'.
         """
         ####
         config_data = type('config_obj', (object,), {})()
@@ -784,18 +2784,34 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
             result_dir = os.path.join(temp_dir, 'output')
         config_data.result_dir = result_dir
         config_data.selection = selection
+        if plan_threads:
+            # The tools 'lr' runs in parallel are the registrations of its inputs
+            number_of_cpu, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS = \
+                self.threadPlanner.plan('BRAINSFit' if algo == 'lr' else algo, len(selection), number_of_cpu,
+                                        ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS)
         if ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS:
             config_data.ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS = ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS
+        if number_of_cpu:
+            config_data.number_of_cpu = number_of_cpu
         config_data.clean = clean
+        config_data.run_cache = run_cache
+        if profile:
+            config_data.profile = profile
         if algo == 'lr':  # Low-rank
             config_data.registration = registration
             config_data.histogram_matching = histogram_matching
             config_data.sigma = sigma
+            config_data.preprocessing_cache = preprocessing_cache
+            if previous_result_dir:
+                config_data.previous_result_dir = previous_result_dir
+            if mask_fn:
+                config_data.mask_fn = mask_fn
+            config_data.sparse_storage = sparse_storage
         else:
             config_data.num_of_iterations_per_level = num_of_iterations_per_level
             config_data.num_of_levels = num_of_levels
-            if number_of_cpu:
-              config_data.number_of_cpu = number_of_cpu
+            if memory_budget:
+                config_data.memory_budget = memory_budget
             if ants_params is None:
                 ants_params = {'Convergence': '[100x50x25,1e-6,10]',\
                                'Dimension': 3,\
@@ -829,6 +2845,7 @@ class LowRankImageDecompositionLogic(ScriptedLoadableModuleLogic):
         else:
             return path
 
+
 class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
     """
   This is the test case for your scripted module.
@@ -848,11 +2865,34 @@ class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
         self.test_softwarePaths()
         self.test_softwarePaths_PATH_unchanged()
         self.test_loadJSONFile()
+        self.test_datasetRegistry()
+        self.test_missingInputs()
+        self.test_progressTracker()
+        self.test_errorLogCursor()
+        self.test_workerProfiler()
+        self.test_concurrencyLimit()
+        self.test_threadPlanner()
+        self.test_inputValidator()
+        self.test_preprocessingCache()
+        self.test_uncompressedCache()
+        self.test_resultStore()
+        self.test_runCache()
+        self.test_lowRankBasis()
+        self.test_lowRankSweep()
+        self.test_lowRankSweepPyLAR()
+        self.test_maskedLowRankDecomposition()
+        self.test_sparseImage()
         self.test_createConfiguration()
         self.test_createExampleConfigurationAndListFiles()
         self.test_downloadData()
+        self.test_downloadDataMirrors()
+        self.test_downloadDataArchive()
+        # test_downloadDataLocalServer needs the LocalDataServer of Testing/Python: it is run by
+        # Testing/Python/LowRankImageDecompositionLogicTest.py
+        self.test_resultVolumeCache()
         self.test_lowRankImageDecomposition()
         self.test_lowRankImageDecompositionExtraNode()
+        self.test_lowRankImageDecompositionPipelined()
         
 
     def test_softwarePaths(self):
@@ -925,6 +2965,692 @@ class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
                         % (str(expected_value), str(downloads['files']['fMeanSimu.nrrd'])))
         self.delayDisplay('test_loadJSONFile passed!')
 
+    def test_datasetRegistry(self):
+        """ Test that the dataset registry indexes the JSON files and returns stable selections.
+
+        Manifests should be loaded only once, files should be kept in the order of the JSON file,
+        and queries by subject and modality should return the positions of the matching files.
+        """
+        self.delayDisplay("Starting test_datasetRegistry")
+        logic = LowRankImageDecompositionLogic()
+        registry = logic.registry
+        json_file_name = "HealthyVolunteers-T1-MPRage.json"
+        downloads = logic.loadJSONFile(json_file_name)
+        self.assertTrue(logic.loadJSONFile(json_file_name) == downloads, 'Manifest content changed between calls')
+        selection = logic.selectData(json_file_name, subjects=range(10, 41))
+        self.assertTrue(selection == sorted(selection), 'Selection not sorted: %r' % selection)
+        names = downloads['files'].keys()
+        for i in selection:
+            subject, modality = registry.parseName(names[i])
+            self.assertTrue(10 <= subject <= 40, 'Unexpected subject %d for %s' % (subject, names[i]))
+            self.assertTrue(modality == 'T1-MPRage', 'Got %s. Expected T1-MPRage' % modality)
+        entries = registry.query(subjects=[78], modality='MRA')
+        self.assertTrue([e.name for e in entries] == ['Normal078-MRA.mha'], 'Got %r' % entries)
+        self.assertTrue(logic.selectData("Bullseye.json", names=["fMeanSimu.nrrd"]) == [0],
+                        'fMeanSimu.nrrd should be the first file of Bullseye.json')
+        self.delayDisplay('test_datasetRegistry passed!')
+
+    def test_missingInputs(self):
+        """ Test that only selected images missing from the cache directory are downloaded before a run.
+
+        Images that are not selected, that are not in the cache directory, or that are not listed in
+        any JSON file should not be downloaded.
+        """
+        self.delayDisplay("Starting test_missingInputs")
+        logic = LowRankImageDecompositionLogic()
+        cache_dir = slicer.app.settings().value('Cache/Path')
+        im_fns = [os.path.join(cache_dir, 'simu8.nrrd'),
+                  os.path.join(slicer.app.temporaryPath, 'simu7.nrrd'),
+                  os.path.join(cache_dir, 'notInAnyJSONFile.nrrd'),
+                  os.path.join(cache_dir, 'simu6.nrrd')]
+        fetch = logic._missingInputs(im_fns, [0, 1, 2])
+        if os.path.isfile(im_fns[0]):
+            self.assertTrue(fetch == [], 'Got %r. Expected nothing to download.' % fetch)
+        else:
+            expected = [(logic.loadJSONFile("Bullseye.json"), [16])]
+            self.assertTrue(fetch == expected, 'Got %r. Expected %r' % (fetch, expected))
+        self.delayDisplay('test_missingInputs passed!')
+
+    def test_progressTracker(self):
+        """ Test that progress reports are coalesced.
+
+        The callback should be called when a task begins and when it is complete, but not for every
+        intermediate update. No fraction should be computed when the amount of work is unknown.
+        """
+        self.delayDisplay("Starting test_progressTracker")
+        calls = []
+        progress = ProgressTracker(lambda: calls.append(1), min_interval=3600)
+        progress.begin('Test', 4, 'iterations')
+        del calls[:]
+        for i in range(3):
+            progress.advance()
+        self.assertTrue(len(calls) == 0, 'Intermediate updates were not coalesced: %d calls' % len(calls))
+        snapshot = progress.snapshot()
+        self.assertTrue(snapshot['fraction'] == 0.75, 'Got %r. Expected 0.75' % snapshot['fraction'])
+        self.assertTrue(snapshot['eta'] is not None, 'ETA should be computed')
+        progress.advance()
+        self.assertTrue(len(calls) == 1, 'Completion was not reported')
+        self.assertTrue(ProgressTracker().snapshot()['fraction'] is None, 'Unknown total should give no fraction')
+        self.delayDisplay('test_progressTracker passed!')
+
+    def test_errorLogCursor(self):
+        """ Test that only the log entries added since the last call are returned, and at most 'capacity' of them.
+        """
+        self.delayDisplay("Starting test_errorLogCursor")
+
+        class LogModel(object):
+            def __init__(self):
+                self.entries = ['previous entry']
+
+            def logEntryCount(self):
+                return len(self.entries)
+
+            def logEntryDescription(self, index):
+                return self.entries[index]
+
+        model = LogModel()
+        cursor = ErrorLogCursor(model, capacity=10)
+        cursor.start()
+        self.assertTrue(cursor.drain() is None, 'Entries added before start() returned')
+        model.entries += ['message %d' % i for i in range(25)]
+        lines = cursor.drain()
+        self.assertTrue(lines == ['message %d' % i for i in range(15, 25)], 'Got %r' % lines)
+        self.assertTrue(cursor.drain() is None, 'Entries returned twice')
+        model.entries.append('message 25')
+        self.assertTrue(cursor.drain() == ['message 25'], 'New entry not returned')
+        model.entries = ['after clear']
+        self.assertTrue(cursor.drain() == ['after clear'], 'Entries lost after the model was cleared')
+        self.delayDisplay('test_errorLogCursor passed!')
+
+    def test_workerProfiler(self):
+        """ Test that a worker is profiled, and that the time spent in the external tools run with
+        'WorkerProfiler.call()' is recorded only while the worker runs.
+        """
+        self.delayDisplay("Starting test_workerProfiler")
+        output_dir = os.path.join(slicer.app.temporaryPath, 'test_workerProfiler')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        tool = LowRankImageDecompositionLogic().softwarePaths().EXE_BRAINSFit or sys.executable
+
+        def worker(count):
+            with open(os.devnull, 'w') as devnull:
+                WorkerProfiler.call([tool, '--version'], stdout=devnull, stderr=devnull)
+            return sum(i * i for i in range(count))
+
+        profiler = WorkerProfiler(output_dir, top=5)
+        self.assertTrue(profiler.runcall(worker, 1000) == sum(i * i for i in range(1000)), 'Wrong returned value')
+        with open(os.devnull, 'w') as devnull:
+            WorkerProfiler.call([tool, '--version'], stdout=devnull, stderr=devnull)
+        self.assertTrue(profiler.tools[os.path.basename(tool)][0] == 1, 'Got %r' % dict(profiler.tools))
+        profiles = glob.glob(os.path.join(output_dir, 'profile_worker_*.prof'))
+        summaries = glob.glob(os.path.join(output_dir, 'profile_worker_*.txt'))
+        self.assertTrue(len(profiles) == 1 and len(summaries) == 1, 'Got %r' % os.listdir(output_dir))
+        with open(summaries[0], 'r') as f:
+            summary = f.read()
+        self.assertTrue(os.path.basename(tool) in summary and 'worker' in summary, summary)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        self.delayDisplay('test_workerProfiler passed!')
+
+    def test_concurrencyLimit(self):
+        """ Test the number of tools the limit lets run in parallel.
+
+        The tools should fit in the memory budget and in the available memory minus the reserve, without
+        exceeding the requested number of tools, and at least one tool should always run. A 'number_of_cpu'
+        set by the user should be kept, and 'number_of_cpu' should only be set when the limit is binding.
+        """
+        self.delayDisplay("Starting test_concurrencyLimit")
+        MB = 1048576
+        concurrency = ConcurrencyLimit(['antsRegistration'], memory_budget=1000 * MB, reserve=100 * MB)
+        self.assertTrue(concurrency.limit(8, 300 * MB, 4000 * MB) == 3, 'Budget not respected')
+        self.assertTrue(concurrency.limit(2, 300 * MB, 4000 * MB) == 2, 'Requested number of tools exceeded')
+        self.assertTrue(concurrency.limit(8, 300 * MB, 700 * MB) == 2, 'Available memory not respected')
+        self.assertTrue(concurrency.limit(8, 2000 * MB, 4000 * MB) == 1, 'At least one tool should run')
+        self.assertTrue(concurrency.limit(8, 0, 4000 * MB) == 8, 'Unknown peak memory should not limit tools')
+        self.assertTrue(concurrency.estimate(100 ** 3) == 100 ** 3 * concurrency.bytes_per_voxel, 'Wrong estimate')
+        logic = LowRankImageDecompositionLogic()
+        config = type('config_obj', (object,), {})()
+        # Budget too small for 2 tools (binding unless there is a single core), and tools small enough for any
+        # machine
+        for peak, expected in [(2 * MB, 1 if multiprocessing.cpu_count() > 1 else None), (1, None)]:
+            limit = ConcurrencyLimit([], memory_budget=1 * MB, reserve=0)
+            logic.toolPeakMemory['uab'] = peak
+            run_config = logic._limitConcurrency(limit, 'uab', config, [])
+            self.assertTrue(getattr(run_config, 'number_of_cpu', None) == expected, 'Wrong number_of_cpu')
+            self.assertFalse(hasattr(config, 'number_of_cpu'), 'Configuration of the user modified')
+        config.number_of_cpu = 4
+        run_config = logic._limitConcurrency(ConcurrencyLimit([], memory_budget=1 * MB, reserve=0), 'uab', config, [])
+        self.assertTrue(run_config.number_of_cpu == 4, 'number_of_cpu set by the user not kept')
+        self.delayDisplay('test_concurrencyLimit passed!')
+
+    def test_threadPlanner(self):
+        """ Test that the number of tools run in parallel and their number of threads are consistent.
+
+        On a machine with 64 physical cores split in 2 NUMA nodes, tools should not use more threads
+        than the size of a NUMA node, and all the tools together should not use more threads than cores.
+        """
+        self.delayDisplay("Starting test_threadPlanner")
+        planner = ThreadPlanner({'logical': 128, 'physical': 64, 'nodes': [64, 64]})
+        self.assertTrue(planner.plan('uab') == (16, 4), 'Got %r' % (planner.plan('uab'),))
+        self.assertTrue(planner.plan('nglra', number_of_cpu=8) == (8, 8), 'Got %r' % (planner.plan('nglra', 8),))
+        self.assertTrue(planner.plan('uab', itk_threads=2) == (32, 2), 'Got %r' % (planner.plan('uab', None, None, 2),))
+        self.assertTrue(planner.plan('uab', number_of_images=4) == (4, 16), 'Got %r' % (planner.plan('uab', 4),))
+        self.assertTrue(planner.plan('uab', number_of_images=1) == (1, 32), 'Got %r' % (planner.plan('uab', 1),))
+        self.assertTrue(planner.plan('lr') == (1, 64), 'Got %r' % (planner.plan('lr'),))
+        self.assertTrue(planner.plan('BRAINSFit', 8) == (8, 8), 'Got %r' % (planner.plan('BRAINSFit', 8),))
+        planner.calibrated['uab'] = 8
+        self.assertTrue(planner.plan('uab') == (8, 8), 'Got %r' % (planner.plan('uab'),))
+        self.assertTrue(planner._countCPUs('0-15,32-47\n') == 32, 'Wrong NUMA node CPU count')
+        self.delayDisplay('test_threadPlanner passed!')
+
+    def test_inputValidator(self):
+        """ Test that all the problems of the input images are reported, and that geometry is only checked
+        when images must be on the grid of the reference image.
+        """
+        self.delayDisplay("Starting test_inputValidator")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_inputValidator')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        reference = sitk.Image([8, 8, 8], sitk.sitkFloat32)
+        images = {'reference': reference, 'same': reference, 'spacing': sitk.Image([8, 8, 8], sitk.sitkFloat32),
+                  'slice': sitk.Image([8, 8], sitk.sitkFloat32),
+                  'vector': sitk.Image([8, 8, 8], sitk.sitkVectorFloat32, 3)}
+        images['spacing'].SetSpacing([1.0, 1.0, 2.0])
+        filenames = {}
+        for name, image in images.items():
+            filenames[name] = os.path.join(temp_dir, name + '.nrrd')
+            sitk.WriteImage(image, filenames[name])
+        filenames['missing'] = os.path.join(temp_dir, 'missing.nrrd')
+        filenames['corrupted'] = os.path.join(temp_dir, 'corrupted.nrrd')
+        with open(filenames['corrupted'], 'w') as f:
+            f.write('not an image')
+        inputs = [filenames[name] for name in ['same', 'spacing', 'slice', 'vector', 'missing', 'corrupted']]
+        problems = InputValidator(filenames['reference']).validate(inputs)
+        self.assertTrue(sorted(set(f for f, problem in problems)) ==
+                        sorted(filenames[name] for name in ['slice', 'vector', 'missing', 'corrupted']),
+                        'Got %r' % problems)
+        problems = InputValidator(filenames['reference'], same_grid=True).validate(inputs)
+        self.assertTrue(filenames['spacing'] in [f for f, problem in problems], 'Got %r' % problems)
+        self.assertTrue(filenames['same'] not in [f for f, problem in problems], 'Got %r' % problems)
+        problems = InputValidator(filenames['missing']).validate(inputs)
+        self.assertTrue(problems == [(filenames['missing'], 'reference image: file not found')], 'Got %r' % problems)
+        # The mask of a masked decomposition is checked with the input images
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', filenames['reference'], None, [0], registration='none',
+                                           mask_fn=filenames['slice'])
+        with self.assertRaisesRegexp(Exception, 'mask: dimension is 2'):
+            logic.validateInputs('lr', config, [filenames['same']])
+        config.mask_fn = filenames['spacing']
+        logic.validateInputs('lr', config, [filenames['same']])
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_inputValidator passed!')
+
+    def test_preprocessingCache(self):
+        """ Test that preprocessed images are reused and that the cache size is bounded.
+
+        Preprocessing the same image twice with the same parameters should return the cached image.
+        Changing the parameters should create a new image, and the least recently used image should be
+        removed when the cache is too small to contain both.
+        """
+        self.delayDisplay("Starting test_preprocessingCache")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_preprocessingCache')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        input_fn = os.path.join(temp_dir, 'input.nrrd')
+        image = sitk.GaussianSource(sitk.sitkFloat32, [32, 32, 32], [8, 8, 8], [16, 16, 16])
+        sitk.WriteImage(image, input_fn)
+        cache = PreprocessingCache(os.path.join(temp_dir, 'cache'))
+        smoothed = cache.preprocess(input_fn, None, sigma=1.0)
+        self.assertTrue(cache.preprocess(input_fn, None, sigma=1.0) == smoothed, 'Cached image not reused')
+        cache.max_size = os.path.getsize(smoothed) * 1.5
+        mtime = os.path.getmtime(smoothed)
+        os.utime(smoothed, (mtime - 10, mtime - 10))
+        smoothed2 = cache.preprocess(input_fn, None, sigma=2.0)
+        self.assertTrue(smoothed2 != smoothed, 'Different parameters should give a different image')
+        self.assertTrue(not os.path.isfile(smoothed), 'Least recently used image was not removed')
+        self.assertTrue(os.path.isfile(smoothed2), 'Most recent image was removed')
+        # The cache is opt-in, and the configuration given by the user is never modified
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', input_fn, None, [0], registration='none', sigma=1.0)
+        self.assertTrue(logic._preprocessInputs('lr', config, None, [input_fn]) == (config, [input_fn], None),
+                        'Preprocessing cache should be disabled by default')
+        config.preprocessing_cache = 10
+        run_config, im_fns, work_dir = logic._preprocessInputs('lr', config, None, [input_fn])
+        self.assertTrue(im_fns[0] != input_fn and run_config.sigma == 0, 'Cached preprocessing not used')
+        self.assertTrue(run_config.registration == 'none' and not run_config.histogram_matching,
+                        'pyLAR should not register and preprocess the images again')
+        self.assertTrue(not im_fns[0].startswith(config.result_dir), 'Intermediate images written in result_dir')
+        self.assertTrue(config.sigma == 1.0, 'Configuration of the user was modified')
+        shutil.rmtree(work_dir, ignore_errors=True)
+        # Images prepared while the other images are downloaded are used as they are
+        logic = LowRankImageDecompositionLogic()
+        config.preprocessing_cache = 0
+        work_dir = os.path.join(temp_dir, 'pipelined')
+        prepared_fn = logic._prepareInput(config, None, input_fn, work_dir)
+        self.assertTrue(prepared_fn.startswith(work_dir), 'Image not prepared in the work directory')
+        run_config, im_fns, run_work_dir = logic._preprocessInputs('lr', config, None, [input_fn],
+                                                                   {os.path.realpath(input_fn): prepared_fn})
+        self.assertTrue(im_fns == [prepared_fn] and run_config.sigma == 0 and run_work_dir is None,
+                        'Prepared images not used')
+        # Hashes verified after a download are reused
+        cache.rememberHash(input_fn, 'verified')
+        self.assertTrue(cache.fileHash(input_fn) == 'verified', 'Verified hash not reused')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_preprocessingCache passed!')
+
+    def test_uncompressedCache(self):
+        """ Test that compressed images are copied uncompressed once, and that uncompressed images are used as they are.
+        """
+        self.delayDisplay("Starting test_uncompressedCache")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_uncompressedCache')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        image = sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8])
+        compressed_fn = os.path.join(temp_dir, 'compressed.nrrd')
+        raw_fn = os.path.join(temp_dir, 'raw.mha')
+        sitk.WriteImage(image, compressed_fn, True)
+        sitk.WriteImage(image, raw_fn, False)
+        self.assertTrue(UncompressedCache.isCompressed(compressed_fn), 'Compressed image not detected')
+        self.assertTrue(not UncompressedCache.isCompressed(raw_fn), 'Uncompressed image detected as compressed')
+        cache = UncompressedCache(os.path.join(temp_dir, 'cache'))
+        self.assertTrue(cache.lookup(compressed_fn) == compressed_fn, 'Copy found before it is written')
+        self.assertTrue(cache.get(raw_fn) == raw_fn, 'Uncompressed image copied')
+        copy_fn = cache.get(compressed_fn)
+        self.assertTrue(copy_fn == os.path.join(temp_dir, 'cache', 'compressed.nrrd'), 'Got %s' % copy_fn)
+        self.assertTrue(not UncompressedCache.isCompressed(copy_fn), 'Copy is compressed')
+        self.assertTrue(numpy.array_equal(sitk.GetArrayFromImage(sitk.ReadImage(copy_fn)),
+                                          sitk.GetArrayFromImage(image)), 'Copy differs from original')
+        inode = os.stat(copy_fn).st_ino
+        self.assertTrue(cache.get(compressed_fn) == copy_fn and os.stat(copy_fn).st_ino == inode,
+                        'Copy written twice')
+        # A copy older than its original is not used
+        mtime = os.path.getmtime(copy_fn)
+        os.utime(copy_fn, (mtime - 10, mtime - 10))
+        os.utime(compressed_fn, (mtime, mtime))
+        self.assertTrue(cache.lookup(compressed_fn) == compressed_fn, 'Outdated copy used')
+        # Least recently used copies are removed when the cache is too small, except those that are kept
+        compressed2_fn = os.path.join(temp_dir, 'compressed2.nrrd')
+        sitk.WriteImage(image, compressed2_fn, True)
+        copy_fn = cache.get(compressed_fn)
+        os.utime(copy_fn, (mtime - 20, mtime - 20))
+        copy2_fn = cache.get(compressed2_fn)
+        cache.max_size = os.path.getsize(copy_fn) * 1.5
+        cache.evict(keep=[copy_fn])
+        self.assertTrue(os.path.isfile(copy_fn) and not os.path.exists(copy2_fn), 'Kept copy removed')
+        cache.evict()
+        self.assertTrue(os.path.isfile(copy_fn), 'Cache smaller than its maximum size evicted')
+        cache.max_size = 0
+        cache.evict()
+        self.assertTrue(not os.path.exists(copy_fn), 'Cache size not bounded')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_uncompressedCache passed!')
+
+    def test_resultStore(self):
+        """ Test that discarded directories disappear immediately and that the quota and retention are enforced.
+
+        Three result directories are created. A discarded directory should not exist anymore when 'discard()'
+        returns. With a quota allowing only one directory, the oldest remaining directory should be removed,
+        except if it contains a file that is explicitly kept. A mount point should be emptied instead.
+        """
+        self.delayDisplay("Starting test_resultStore")
+        root = os.path.join(slicer.app.temporaryPath, 'test_resultStore')
+        shutil.rmtree(root, ignore_errors=True)
+        directories = []
+        for i in range(3):
+            directory = os.path.join(root, 'output%d' % i)
+            os.makedirs(directory)
+            with open(os.path.join(directory, 'list_outputs.txt'), 'w') as f:
+                f.write('x' * 1000)
+            os.utime(directory, (time() - 100 + i, time() - 100 + i))
+            directories.append(directory)
+        os.makedirs(os.path.join(root, 'notAResult'))
+        store = ResultStore(root)
+        store.discard(directories[2])
+        self.assertTrue(not os.path.exists(directories[2]), 'Discarded directory still exists')
+        store.wait()
+        usage = store.usage()
+        self.assertTrue(usage['results'] == 2 and usage['trash'] == 0, 'Got %r' % usage)
+        store.quota = 1500
+        store.enforce(keep=[os.path.join(directories[0], 'input.nrrd')])
+        store.wait()
+        self.assertTrue(os.path.isdir(directories[0]), 'Directory containing a kept file was removed')
+        self.assertTrue(not os.path.exists(directories[1]), 'Quota not enforced')
+        self.assertTrue(os.path.isdir(os.path.join(root, 'notAResult')), 'Directory that is not a result was removed')
+        store.quota = None
+        store.retention = 10
+        store.enforce()
+        store.wait()
+        self.assertTrue(store.usage()['results'] == 0, 'Retention not enforced')
+        # A mount point cannot be renamed: its content is deleted in place
+        mount_point = os.path.join(root, 'mounted')
+        os.makedirs(os.path.join(mount_point, 'output'))
+        with open(os.path.join(mount_point, 'list_outputs.txt'), 'w') as f:
+            f.write('x')
+
+        def busy(source, destination):
+            raise OSError(errno.EBUSY, os.strerror(errno.EBUSY))
+
+        rename = os.rename
+        os.rename = busy
+        try:
+            store.discard(mount_point)
+        finally:
+            os.rename = rename
+        self.assertTrue(os.path.isdir(mount_point) and not os.listdir(mount_point), 'Mount point not emptied')
+        shutil.rmtree(root, ignore_errors=True)
+        self.delayDisplay('test_resultStore passed!')
+
+    def test_runCache(self):
+        """ Verifies that the outputs of a run are reused by an identical run, and only by an identical run.
+
+        Images that are not selected are missing and should not be needed to compute the fingerprint. Outputs
+        should remain available when the result directory is removed before the next run ('clean'), and
+        should be removed when the cache exceeds its maximum size.
+        """
+        self.delayDisplay("Starting test_runCache")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_runCache')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(os.path.join(temp_dir, 'output1'))
+        im_fns = [os.path.join(temp_dir, 'input%d.nrrd' % i) for i in range(3)]
+        for im_fn in im_fns[:2]:
+            with open(im_fn, 'w') as f:
+                f.write(im_fn)
+        outputs = [os.path.join(temp_dir, 'output1', 'L%d.nrrd' % i) for i in range(2)]
+        for output in outputs:
+            with open(output, 'w') as f:
+                f.write(output)
+        pyLAR.writeTxtFromList(os.path.join(temp_dir, 'output1', 'list_outputs.txt'), outputs)
+        logic = LowRankImageDecompositionLogic()
+        cache = RunCache(os.path.join(temp_dir, 'cache'), PreprocessingCache(temp_dir).fileHash)
+        software = logic.softwarePaths()
+        config = type('config_obj', (object,), {})()
+        config.selection = [0, 1]
+        config.lamda = 2.0
+        config.result_dir = os.path.join(temp_dir, 'output1')
+        fingerprint = cache.fingerprint('lr', config, im_fns, software)
+        self.assertTrue(cache.materialize(fingerprint, os.path.join(temp_dir, 'output2')) is None, 'Unexpected hit')
+        cache.store(fingerprint, config.result_dir)
+        # Output directory and images that are not selected do not change the fingerprint,
+        # parameters and input content do
+        config.result_dir = os.path.join(temp_dir, 'output2')
+        self.assertTrue(cache.fingerprint('lr', config, im_fns, software) == fingerprint, 'Fingerprint changed')
+        with open(im_fns[2], 'w') as f:
+            f.write('not selected')
+        self.assertTrue(cache.fingerprint('lr', config, im_fns, software) == fingerprint, 'Unselected image hashed')
+        config.lamda = 1.0
+        self.assertTrue(cache.fingerprint('lr', config, im_fns, software) != fingerprint, 'Parameter ignored')
+        config.lamda = 2.0
+        self.assertTrue(cache.fingerprint('uab', config, im_fns, software) != fingerprint, 'Algorithm ignored')
+        # Enabling the preprocessing cache changes how images are registered, its size does not change the outputs
+        config.preprocessing_cache = 100
+        with_preprocessing_cache = cache.fingerprint('lr', config, im_fns, software)
+        self.assertTrue(with_preprocessing_cache != fingerprint, 'Preprocessing cache ignored')
+        config.preprocessing_cache = 200
+        self.assertTrue(cache.fingerprint('lr', config, im_fns, software) == with_preprocessing_cache,
+                        'Size of the preprocessing cache should be ignored')
+        del config.preprocessing_cache
+        with open(im_fns[1], 'a') as f:
+            f.write('modified')
+        os.utime(im_fns[1], (0, 0))
+        self.assertTrue(cache.fingerprint('lr', config, im_fns, software) != fingerprint, 'Input content ignored')
+        materialized = cache.materialize(fingerprint, config.result_dir)
+        expected = [os.path.join(temp_dir, 'output2', 'L%d.nrrd' % i) for i in range(2)]
+        self.assertTrue(materialized == expected, 'Got %r' % materialized)
+        self.assertTrue(pyLAR.readTxtIntoList(os.path.join(config.result_dir, 'list_outputs.txt')) == expected,
+                        'list_outputs.txt not written')
+        # Outputs remain available when all the result directories are removed, e.g. to run in a clean directory
+        shutil.rmtree(os.path.join(temp_dir, 'output1'))
+        shutil.rmtree(os.path.join(temp_dir, 'output2'))
+        materialized = cache.materialize(fingerprint, os.path.join(temp_dir, 'output1'))
+        self.assertTrue(materialized == outputs, 'Got %r' % materialized)
+        with open(outputs[0], 'r') as f:
+            self.assertTrue(f.read() == outputs[0], 'Wrong output content')
+        cache.max_size = 0
+        cache.evict()
+        self.assertTrue(cache.materialize(fingerprint, os.path.join(temp_dir, 'output3')) is None,
+                        'Cache size not bounded')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_runCache passed!')
+
+    def test_lowRankBasis(self):
+        """ Test the decomposition of a new image using the low-rank images of a previous run.
+
+        The previous run is simulated with rank-1 low-rank images. A new image made of a scaled version of
+        these images plus a single bright voxel should be decomposed into the scaled image (low-rank) and
+        the bright voxel (sparse). The basis should be saved in the previous result directory.
+        New images should be preprocessed like the images of the previous run.
+        """
+        self.delayDisplay("Starting test_lowRankBasis")
+        result_dir = os.path.join(slicer.app.temporaryPath, 'test_lowRankBasis')
+        shutil.rmtree(result_dir, ignore_errors=True)
+        os.makedirs(result_dir)
+        base = sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8])
+        low_rank_fns = []
+        sparse_fns = []
+        for i in range(3):
+            low_rank_fns.append(os.path.join(result_dir, 'image%d_low_rank.nrrd' % i))
+            sitk.WriteImage(base * (i + 1.0), low_rank_fns[-1])
+            sparse_fns.append(os.path.join(result_dir, 'image%d_sparse.nrrd' % i))
+            sitk.WriteImage(base * 0.0, sparse_fns[-1])
+        pyLAR.writeTxtFromList(os.path.join(result_dir, 'list_outputs.txt'), low_rank_fns[:2] + sparse_fns)
+        with self.assertRaisesRegexp(Exception, 'should list 2 low-rank images and 2 sparse images'):
+            LowRankBasis.fromResultDir(result_dir)
+        pyLAR.writeTxtFromList(os.path.join(result_dir, 'list_outputs.txt'), low_rank_fns + sparse_fns)
+        new_image = base * 5.0
+        new_image.SetPixel(2, 2, 2, new_image.GetPixel(2, 2, 2) + 100.0)
+        new_image_fn = os.path.join(result_dir, 'new.nrrd')
+        sitk.WriteImage(new_image, new_image_fn)
+        basis = LowRankBasis.fromResultDir(result_dir)
+        self.assertTrue(basis.basis.shape[1] == 1, 'Got rank %d. Expected 1' % basis.basis.shape[1])
+        self.assertTrue(os.path.isfile(os.path.join(result_dir, LowRankBasis.file_name)), 'Basis not saved')
+        low_rank_fn = os.path.join(result_dir, 'new_LowRank.nrrd')
+        sparse_fn = os.path.join(result_dir, 'new_Sparse.nrrd')
+        LowRankBasis.fromResultDir(result_dir).decompose(new_image_fn, low_rank_fn, sparse_fn)
+        sparse = sitk.GetArrayFromImage(sitk.ReadImage(sparse_fn))
+        self.assertTrue(numpy.unravel_index(numpy.argmax(sparse), sparse.shape) == (2, 2, 2),
+                        'Sparse component does not contain the bright voxel')
+        low_rank = sitk.GetArrayFromImage(sitk.ReadImage(low_rank_fn))
+        self.assertTrue(numpy.allclose(low_rank + sparse, sitk.GetArrayFromImage(new_image), atol=1e-3),
+                        'Low-rank and sparse components do not add up to the image')
+        # The new image is smoothed like the images of the previous run
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', low_rank_fns[0], None, range(3), registration='none', sigma=1.0)
+        LowRankBasis.saveParameters(result_dir, config)
+        config = logic.createConfiguration('lr', low_rank_fns[0], None, [0], registration='none',
+                                           previous_result_dir=result_dir)
+        output_dir = os.path.join(result_dir, 'incremental')
+        os.makedirs(output_dir)
+        logic.thread_incrementalLowRank(config, None, [new_image_fn], output_dir)
+        outputs = pyLAR.readTxtIntoList(os.path.join(output_dir, 'list_outputs.txt'))
+        self.assertTrue([os.path.basename(f) for f in outputs] == ['new_LowRank.nrrd', 'new_Sparse.nrrd'],
+                        'Got %r' % outputs)
+        decomposed = sum(sitk.GetArrayFromImage(sitk.ReadImage(f)) for f in outputs)
+        smoothed = sitk.GetArrayFromImage(sitk.SmoothingRecursiveGaussian(new_image, 1.0))
+        self.assertTrue(numpy.allclose(decomposed, smoothed, atol=1e-3), 'New image was not preprocessed')
+        shutil.rmtree(result_dir, ignore_errors=True)
+        self.delayDisplay('test_lowRankBasis passed!')
+
+    def test_lowRankSweep(self):
+        """ Test that each point of a parameter sweep is decomposed with its own value of 'lamda'.
+
+        Images are made of a rank-1 component plus one bright voxel per image, and are decomposed inside a mask
+        so that the sweep does not need pyLAR. A larger value of 'lamda' should not give a less sparse
+        component, and the configuration given to the sweep should not be modified.
+        """
+        self.delayDisplay("Starting test_lowRankSweep")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_lowRankSweep')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        base = sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8])
+        im_fns = []
+        for i in range(6):
+            image = base * (i + 1.0)
+            image.SetPixel(i, i, i, image.GetPixel(i, i, i) + 50.0)
+            im_fns.append(os.path.join(temp_dir, 'image%d.nrrd' % i))
+            sitk.WriteImage(image, im_fns[-1])
+        mask_fn = os.path.join(temp_dir, 'mask.nrrd')
+        sitk.WriteImage(sitk.Cast(base > -1.0, sitk.sitkUInt8), mask_fn)
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', im_fns[0], None, range(6), lamda=1.0, registration='none',
+                                           mask_fn=mask_fn)
+        result_dir = os.path.join(temp_dir, 'sweep')
+        rows = logic.thread_sweep(config, None, im_fns, result_dir, [2.0, 0.5], [0, 1.0])
+        self.assertTrue([(row['lamda'], row['sigma']) for row in rows] == [(0.5, 0), (2.0, 0), (0.5, 1.0), (2.0, 1.0)],
+                        'Got %r' % rows)
+        self.assertTrue(config.lamda == 1.0 and config.sigma == 0, 'Configuration of the sweep was modified')
+        with open(os.path.join(result_dir, 'sweep_summary.csv'), 'r') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[0] == 'lamda,sigma,rank,sparsity,residual,time,output_dir' and len(lines) == 5,
+                        'Got summary %r' % lines)
+        non_zero = []
+        for row in rows[:2]:
+            outputs = pyLAR.readTxtIntoList(os.path.join(row['output_dir'], 'list_outputs.txt'))
+            self.assertTrue(len(outputs) == 12, 'Got %d outputs' % len(outputs))
+            non_zero.append(sum(numpy.count_nonzero(sitk.GetArrayFromImage(sitk.ReadImage(f))) for f in outputs[6:]))
+        self.assertTrue(non_zero[1] <= non_zero[0], 'Non-zero sparse voxels: %r' % non_zero)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_lowRankSweep passed!')
+
+    def test_lowRankSweepPyLAR(self):
+        """ Test a parameter sweep decomposed by pyLAR.
+
+        Images are made of a rank-1 component plus one bright voxel per image. Each point should have its own
+        output directory, and the summary should list the rank, sparsity and residual of each point, computed
+        from its outputs.
+        """
+        self.delayDisplay("Starting test_lowRankSweepPyLAR")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_lowRankSweepPyLAR')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        base = sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8])
+        im_fns = []
+        for i in range(6):
+            image = base * (i + 1.0)
+            image.SetPixel(i, i, i, image.GetPixel(i, i, i) + 50.0)
+            im_fns.append(os.path.join(temp_dir, 'image%d.nrrd' % i))
+            sitk.WriteImage(image, im_fns[-1])
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', im_fns[0], None, range(6), registration='none')
+        result_dir = os.path.join(temp_dir, 'sweep')
+        rows = logic.thread_sweep(config, logic.softwarePaths(), im_fns, result_dir, [0.5, 2.0], [0, 1.0])
+        with open(os.path.join(result_dir, 'sweep_summary.csv'), 'r') as f:
+            lines = f.read().splitlines()
+        self.assertTrue(len(lines) == 5, 'Got summary %r' % lines)
+        for line, row in zip(lines[1:], rows):
+            lamda, sigma, rank, sparsity, residual, elapsed, output_dir = line.split(',')
+            self.assertTrue((float(lamda), float(sigma)) == (row['lamda'], row['sigma']), 'Got %s' % line)
+            self.assertTrue(output_dir == os.path.join(result_dir, 'lamda_%g_sigma_%g' % (row['lamda'], row['sigma'])),
+                            'Got %s' % line)
+            outputs = pyLAR.readTxtIntoList(os.path.join(output_dir, 'list_outputs.txt'))
+            self.assertTrue(len(outputs) == 12 and all(os.path.isfile(f) for f in outputs),
+                            'Outputs missing in %s' % output_dir)
+            self.assertTrue(int(rank) >= 1 and 0 <= float(sparsity) <= 1 and float(residual) < 0.01,
+                            'Got %s' % line)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_lowRankSweepPyLAR passed!')
+
+    def test_maskedLowRankDecomposition(self):
+        """ Test that only the voxels inside the mask are decomposed, and that outputs are full images.
+
+        Warm-started decompositions should converge in fewer iterations to a solution of the same rank and no
+        larger objective than decompositions started from zero.
+        """
+        self.delayDisplay("Starting test_maskedLowRankDecomposition")
+        base = sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8])
+        images = []
+        for i in range(4):
+            image = base * (i + 1.0)
+            image.SetPixel(6 + i, 8, 8, image.GetPixel(6 + i, 8, 8) + 50.0)
+            images.append(image)
+        mask = sitk.Image(base.GetSize(), sitk.sitkUInt8)
+        mask.CopyInformation(base)
+        mask = sitk.Paste(mask, sitk.Image([8, 8, 8], sitk.sitkUInt8) + 1, [8, 8, 8], [0, 0, 0], [4, 4, 4])
+        decomposition = MaskedLowRankDecomposition(images, mask=mask)
+        self.assertTrue(decomposition.data.shape == (512, 4),
+                        'Got data matrix of shape %r' % (decomposition.data.shape,))
+        result = decomposition.decompose(1.0)
+        output_dir = os.path.join(slicer.app.temporaryPath, 'test_maskedLowRankDecomposition')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        outputs = decomposition.writeImages(result, output_dir, ['image%d' % i for i in range(4)])
+        low_rank = sitk.GetArrayFromImage(sitk.ReadImage(outputs[0]))
+        sparse = sitk.GetArrayFromImage(sitk.ReadImage(outputs[4]))
+        self.assertTrue(low_rank.shape == (16, 16, 16), 'Got image of shape %r' % (low_rank.shape,))
+        inside = sitk.GetArrayFromImage(mask) > 0
+        self.assertTrue(not low_rank[~inside].any() and not sparse[~inside].any(), 'Non-zero voxels outside the mask')
+        original = sitk.GetArrayFromImage(images[0])
+        self.assertTrue(numpy.abs(low_rank + sparse - original)[inside].max() < 1e-3 * original.max(),
+                        'Low-rank + sparse does not match the image inside the mask')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        # A mask on another grid is resampled on the grid of the reference image
+        im_fns = []
+        os.makedirs(output_dir)
+        for i, image in enumerate(images):
+            im_fns.append(os.path.join(output_dir, 'image%d.nrrd' % i))
+            sitk.WriteImage(image, im_fns[-1])
+        coarse_mask = sitk.Image([8, 8, 8], sitk.sitkUInt8)
+        coarse_mask.SetSpacing([2.0, 2.0, 2.0])
+        coarse_mask.SetOrigin([0.5, 0.5, 0.5])  # Each voxel covers 2x2x2 voxels of the images
+        coarse_mask = sitk.Paste(coarse_mask, sitk.Image([4, 4, 4], sitk.sitkUInt8) + 1, [4, 4, 4], [0, 0, 0],
+                                 [2, 2, 2])
+        mask_fn = os.path.join(output_dir, 'mask.nrrd')
+        sitk.WriteImage(coarse_mask, mask_fn)
+        logic = LowRankImageDecompositionLogic()
+        config = logic.createConfiguration('lr', im_fns[0], None, range(4), registration='none', mask_fn=mask_fn)
+        result_dir = os.path.join(output_dir, 'result')
+        logic.thread_maskedLowRank(config, None, im_fns, result_dir)
+        outputs = pyLAR.readTxtIntoList(os.path.join(result_dir, 'list_outputs.txt'))
+        low_rank = sitk.GetArrayFromImage(sitk.ReadImage(outputs[0]))
+        self.assertTrue(low_rank.shape == (16, 16, 16) and not low_rank[~inside].any() and low_rank[inside].all(),
+                        'Mask not resampled on the grid of the reference image')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        # Warm start
+        images = []
+        for i in range(6):
+            image = base * (i + 1.0)
+            image.SetPixel(i, i, i, image.GetPixel(i, i, i) + 50.0)
+            images.append(image)
+        decomposition = MaskedLowRankDecomposition(images)
+        first = decomposition.decompose(1.0)
+        cold = decomposition.decompose(1.2)
+        warm = decomposition.decompose(1.2, start=first)
+        self.assertTrue(warm['iterations'] < cold['iterations'],
+                        'Warm start: %d iterations. Cold start: %d' % (warm['iterations'], cold['iterations']))
+        self.assertTrue(warm['rank'] == cold['rank'], 'Got rank %d. Expected %d' % (warm['rank'], cold['rank']))
+        self.assertTrue(warm['objective'] <= cold['objective'] * 1.001,
+                        'Warm start objective: %g. Cold start: %g' % (warm['objective'], cold['objective']))
+        self.delayDisplay('test_maskedLowRankDecomposition passed!')
+
+    def test_sparseImage(self):
+        """ Test that sparse images are stored in less space and are read back identically.
+        """
+        self.delayDisplay("Starting test_sparseImage")
+        temp_dir = os.path.join(slicer.app.temporaryPath, 'test_sparseImage')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        os.makedirs(temp_dir)
+        image = sitk.Image([32, 24, 16], sitk.sitkFloat32)
+        image.SetSpacing([0.5, 1.0, 2.0])
+        image.SetOrigin([10.0, -5.0, 3.0])
+        image.SetDirection([0, 1, 0, -1, 0, 0, 0, 0, 1])
+        for i in range(20):
+            image.SetPixel(i, i % 24, i % 16, float(i) - 10.5)
+        image.SetPixel(0, 0, 0, 1.0)
+        dense_fn = os.path.join(temp_dir, 'S_0_image.nrrd')
+        sitk.WriteImage(image, dense_fn)
+        self.assertTrue(SparseImage.sparse_pattern.search('Iter1_S_3.nrrd') and
+                        not SparseImage.sparse_pattern.search('Iter1_L_3.nrrd'), 'Wrong sparse image pattern')
+        dense_size = os.path.getsize(dense_fn)
+        sparse_fn = SparseImage.compress(dense_fn)
+        self.assertTrue(sparse_fn == os.path.join(temp_dir, 'S_0_image' + SparseImage.extension), 'Got %s' % sparse_fn)
+        self.assertTrue(not os.path.exists(dense_fn), 'Dense image not removed')
+        self.assertTrue(os.path.getsize(sparse_fn) < dense_size / 10, 'Sparse image is not compact')
+        self.assertTrue(SparseImage.baseName(sparse_fn) == 'S_0_image', 'Got %s' % SparseImage.baseName(sparse_fn))
+        expanded = SparseImage.read(sparse_fn)
+        self.assertTrue(numpy.array_equal(sitk.GetArrayFromImage(expanded), sitk.GetArrayFromImage(image)),
+                        'Voxels differ')
+        self.assertTrue(expanded.GetPixelID() == image.GetPixelID(), 'Pixel type differs')
+        for method in ['GetSize', 'GetSpacing', 'GetOrigin', 'GetDirection']:
+            self.assertTrue(numpy.allclose(getattr(expanded, method)(), getattr(image, method)()), method + ' differs')
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        self.delayDisplay('test_sparseImage passed!')
+
     def test_createConfiguration(self):
         """ Test the creation of a configuration file.
 
@@ -951,6 +3677,18 @@ class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
         # Loads the configuration file that was saved and compare only the selection indices.
         # If the indices are correct, we hope that everything is correct
         self.assertTrue(config.selection == selection, 'Expected %r. Got %r'%(selection,config.selection))
+        # Threads are only set when asked for
+        config = logic.createConfiguration("uab", "fake_reference_image.nrrd", "fake_file_list_name.txt", selection)
+        self.assertFalse(hasattr(config, 'number_of_cpu'), 'number_of_cpu should not be set by default')
+        self.assertFalse(hasattr(config, 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'), 'ITK threads should not be set')
+        config = logic.createConfiguration("uab", "fake_reference_image.nrrd", "fake_file_list_name.txt", selection,
+                                           plan_threads=True)
+        self.assertTrue(config.number_of_cpu <= len(selection), 'Got %r' % config.number_of_cpu)
+        self.assertTrue(config.ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS >= 1, 'ITK threads not planned')
+        # Registrations of the inputs of 'lr' are run in parallel
+        config = logic.createConfiguration("lr", "fake_reference_image.nrrd", "fake_file_list_name.txt", selection,
+                                           plan_threads=True)
+        self.assertTrue(1 <= config.number_of_cpu <= len(selection), 'Got %r' % config.number_of_cpu)
         self.delayDisplay('test_createConfiguration passed!')
 
     def test_createExampleConfigurationAndListFiles(self):
@@ -1009,6 +3747,163 @@ class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
         self.delayDisplay('test_downloadData passed!')
 
 
+    def test_downloadDataMirrors(self):
+        """ Verifies that data is downloaded from another mirror when a mirror fails.
+
+        The first mirror does not exist and the second one serves a file with the wrong content.
+        The file should be downloaded from the third (local) mirror, and the first two mirrors
+        should be moved to the end of the list of mirrors.
+        """
+        self.delayDisplay("Starting test_downloadDataMirrors")
+        mirror_dir = os.path.join(slicer.app.temporaryPath, 'test_downloadDataMirrors')
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        os.makedirs(os.path.join(mirror_dir, 'good'))
+        os.makedirs(os.path.join(mirror_dir, 'bad'))
+        name = 'test_downloadDataMirrors.txt'
+        with open(os.path.join(mirror_dir, 'good', name), 'w') as f:
+            f.write('good content')
+        with open(os.path.join(mirror_dir, 'bad', name), 'w') as f:
+            f.write('bad content')
+        mirrors = ['file://' + os.path.join(mirror_dir, directory, '{name}') for directory in ['missing', 'bad', 'good']]
+        data_dict = {'mirrors': mirrors, 'files': {name: ['0', hashlib.md5('good content').hexdigest()]}}
+        logic = LowRankImageDecompositionLogic()
+        downloaded = []
+        filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        logic.thread_downloadData(data_dict, on_file=lambda name, filePath: downloaded.append(filePath))
+        self.assertTrue(downloaded == [filePath], 'Got %r' % downloaded)
+        with open(filePath, 'r') as f:
+            self.assertTrue(f.read() == 'good content', 'Wrong file content')
+        selector = MirrorSelector(mirrors)
+        selector.failed(mirrors[0])
+        self.assertTrue(selector.ordered() == mirrors[1:] + mirrors[:1], 'Got %r' % selector.ordered())
+        os.remove(filePath)
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        self.delayDisplay('test_downloadDataMirrors passed!')
+
+    def test_downloadDataArchive(self):
+        """ Verifies that files are extracted from an archive, and that files missing from the archive,
+        or with a wrong content in the archive, are downloaded individually.
+        """
+        self.delayDisplay("Starting test_downloadDataArchive")
+        mirror_dir = os.path.join(slicer.app.temporaryPath, 'test_downloadDataArchive')
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        os.makedirs(os.path.join(mirror_dir, 'bundle'))
+        files = collections.OrderedDict()
+        for index in range(3):
+            name = 'test_downloadDataArchive%d.txt' % index
+            content = 'content %d' % index
+            with open(os.path.join(mirror_dir, name), 'w') as f:
+                f.write(content)
+            files[name] = [name, hashlib.md5(content).hexdigest()]
+        with open(os.path.join(mirror_dir, 'bundle', 'test_downloadDataArchive1.txt'), 'w') as f:
+            f.write('wrong content')
+        with tarfile.open(os.path.join(mirror_dir, 'bundle.tar.gz'), 'w:gz') as archive:
+            archive.add(os.path.join(mirror_dir, 'test_downloadDataArchive0.txt'), 'data/test_downloadDataArchive0.txt')
+            archive.add(os.path.join(mirror_dir, 'bundle', 'test_downloadDataArchive1.txt'),
+                        'data/test_downloadDataArchive1.txt')
+        data_dict = {'url': 'file://' + mirror_dir + '/', 'archive': 'bundle.tar.gz', 'files': files}
+        for name in files.keys():
+            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+            if os.path.exists(filePath):
+                os.remove(filePath)
+        logic = LowRankImageDecompositionLogic()
+        downloaded = []
+        logic.thread_downloadData(data_dict, on_file=lambda name, filePath: downloaded.append(name))
+        self.assertTrue(downloaded == ['test_downloadDataArchive0.txt', 'test_downloadDataArchive1.txt',
+                                       'test_downloadDataArchive2.txt'], 'Got %r' % downloaded)
+        for name in files.keys():
+            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+            self.assertTrue(logic._md5sum(filePath) == files[name][1], 'Wrong content for %s' % name)
+            os.remove(filePath)
+        # An archive interrupted while it is streamed: the files that were not extracted are downloaded individually
+        with tarfile.open(os.path.join(mirror_dir, 'bundle.tar'), 'w') as archive:
+            for name in files.keys():
+                archive.add(os.path.join(mirror_dir, name), 'data/' + name)
+        with open(os.path.join(mirror_dir, 'bundle.tar'), 'rb') as f:
+            content = f.read()
+        with open(os.path.join(mirror_dir, 'truncated.tar'), 'wb') as f:
+            # Cut in the middle of the second member
+            f.write(content[:3 * tarfile.BLOCKSIZE + 4])
+        data_dict['archive'] = 'truncated.tar'
+        downloaded = []
+        logic.thread_downloadData(data_dict, on_file=lambda name, filePath: downloaded.append(name))
+        self.assertTrue(sorted(downloaded) == sorted(files.keys()), 'Got %r' % downloaded)
+        for name in files.keys():
+            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+            self.assertTrue(logic._md5sum(filePath) == files[name][1], 'Wrong content for %s' % name)
+            os.remove(filePath)
+        shutil.rmtree(mirror_dir, ignore_errors=True)
+        self.delayDisplay('test_downloadDataArchive passed!')
+
+    def test_downloadDataLocalServer(self):
+        """ Verifies that images are downloaded and queued in order, without network access.
+
+        Images are served by a LocalDataServer (Testing/Python/LocalDataServer.py). Images that are already in
+        the cache should not be requested again, and a file that is not on the server should raise an exception.
+        """
+        self.delayDisplay("Starting test_downloadDataLocalServer")
+        from LocalDataServer import LocalDataServer
+        server = LocalDataServer(os.path.join(slicer.app.temporaryPath, 'test_downloadDataLocalServer'))
+        names = ['test_downloadDataLocalServer%d.nrrd' % index for index in range(4)]
+        for index, name in enumerate(names):
+            server.addImage(name, value=index)
+            filePath = os.path.join(slicer.app.settings().value('Cache/Path'), name)
+            if os.path.exists(filePath):
+                os.remove(filePath)
+        server.start()
+        try:
+            logic = LowRankImageDecompositionLogic()
+            logic.thread_downloadData(server.manifest(), [0, 2])
+            self.assertTrue(len(server.requests) == 2, 'Got %r' % server.requests)
+            logic.thread_downloadData(server.manifest())
+            self.assertTrue(len(server.requests) == 4, 'Got %r' % server.requests)
+            queued = []
+            while not logic.post_queue.empty():
+                queued.append(logic.post_queue.get_nowait()[0])
+            # Images found in the cache are queued before the images that are downloaded.
+            expected = [names[0], names[2]] + [names[0], names[2], names[1], names[3]]
+            self.assertTrue(queued == expected, 'Got %r' % queued)
+            with self.assertRaisesRegexp(Exception, "could not be downloaded"):
+                logic.thread_downloadData({'url': server.url, 'files': {'missing.nrrd': ['404', '0']}})
+        finally:
+            server.stop()
+            shutil.rmtree(server.directory, ignore_errors=True)
+        for name in names:
+            os.remove(os.path.join(slicer.app.settings().value('Cache/Path'), name))
+        self.delayDisplay('test_downloadDataLocalServer passed!')
+
+    def test_resultVolumeCache(self):
+        """ Test that volumes are loaded only when displayed, and unloaded when the memory limit is reached.
+
+        Two placeholders are created for the same image. Displaying one loads it. With a memory limit
+        smaller than one image, displaying the second one unloads the first one.
+        """
+        self.delayDisplay("Starting test_resultVolumeCache")
+        self.setUp()
+        filepath = os.path.join(slicer.app.temporaryPath, 'test_resultVolumeCache.nrrd')
+        sitk.WriteImage(sitk.GaussianSource(sitk.sitkFloat32, [16, 16, 16], [4, 4, 4], [8, 8, 8]), filepath)
+        cache = ResultVolumeCache(memory_cap=1)
+        first = cache.add('first', filepath)
+        second = cache.add('second', filepath)
+        self.assertTrue(first.GetImageData() is None, 'Placeholder should not contain image data')
+        sliceCompositeNode = slicer.app.layoutManager().sliceWidget('Red').mrmlSliceCompositeNode()
+        sliceCompositeNode.SetBackgroundVolumeID(first.GetID())
+        self.assertTrue(first.GetImageData() is not None, 'Displayed volume was not loaded')
+        sliceCompositeNode.SetBackgroundVolumeID(second.GetID())
+        self.assertTrue(second.GetImageData() is not None, 'Displayed volume was not loaded')
+        self.assertTrue(first.GetImageData() is None, 'Volume not displayed anymore was not unloaded')
+        self.assertTrue(cache.loaded.keys() == [second.GetID()], 'Got %r' % cache.loaded.keys())
+        # Files of the placeholders are kept by the result store until their node is removed
+        self.assertTrue(cache.filePaths() == [filepath, filepath], 'Got %r' % cache.filePaths())
+        slicer.mrmlScene.RemoveNode(first)
+        slicer.mrmlScene.RemoveNode(second)
+        self.assertTrue(cache.filePaths() == [], 'Got %r' % cache.filePaths())
+        cache.clear()
+        os.remove(filepath)
+        self.delayDisplay('test_resultVolumeCache passed!')
+
     def test_lowRankImageDecomposition(self):
         """ Test low rank/sparse decomposition of an image
 
@@ -1119,3 +4014,28 @@ class LowRankImageDecompositionTest(ScriptedLoadableModuleTest):
                         "Got %s, expected %s. Pos %d - whole list %s"
                         %(im_fns_1, expected_extra_image_name,len(im_fns), str(im_fns)))
         self.delayDisplay('test_lowRankImageDecompositionExtraNode passed!')
+
+    def test_lowRankImageDecompositionPipelined(self):
+        """ Test low rank/sparse decomposition of images downloaded while the processing is started
+
+        The configuration file is created without downloading the data. The data is downloaded
+        by the processing thread and pyLAR is run as soon as the selected images are available.
+        """
+        self.delayDisplay("Starting test_lowRankImageDecompositionPipelined")
+        json_file_name = "Bullseye.json"
+        algo = 'lr'
+        logic = LowRankImageDecompositionLogic()
+        lr_test_file_name = os.path.join(slicer.app.temporaryPath, 'lr_pipelined_test_file.txt')
+        result_dir = os.path.join(slicer.app.temporaryPath, 'output_pipelined')
+        shutil.rmtree(result_dir, ignore_errors=True)
+        selection = [0, 4]
+        logic.createExampleConfigurationAndListFiles(lr_test_file_name, json_file_name, algo,
+                                                     selection=selection, output_dir=result_dir,
+                                                     registration='none')
+        logic.run_pyLAR(lr_test_file_name, algo, datafile=json_file_name)
+        if logic.thread.is_alive():
+            logic.thread.join()
+        list_images = pyLAR.readTxtIntoList(os.path.join(result_dir, 'list_outputs.txt'))
+        for image in list_images:
+            self.assertTrue(os.path.isfile(image), 'File not found: %s' % image)
+        self.delayDisplay('test_lowRankImageDecompositionPipelined passed!')
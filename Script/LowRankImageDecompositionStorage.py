@@ -0,0 +1,723 @@
+import os
+import shutil
+import logging
+import SimpleITK as sitk
+import pyLAR
+import json
+import threading
+import Queue
+from time import time
+import errno
+import re
+import hashlib
+import collections
+import copy
+import glob
+
+#
+# LRUCache
+#
+
+class LRUCache(object):
+    """
+  Base class of the caches stored in 'directory', whose least recently used entries are removed when they use
+  more than 'max_size' bytes.
+
+  Subclasses list their entries in 'entries()'. Entries are written with 'write()', which writes into a temporary
+  file or directory first, so that an interruption never leaves an incomplete entry in the cache. Temporary
+  files and directories contain '.tmp' in their name.
+  """
+
+    def __init__(self, directory, max_size=5 * 1024 ** 3):
+        self.directory = directory
+        self.max_size = max_size
+
+    def entries(self):
+        """ Returns the list of (time of last use, size in bytes, paths) of the entries of the cache. 'paths' are
+        removed in order to remove the entry: the entry is kept if the first one cannot be removed.
+        """
+        raise NotImplementedError
+
+    def write(self, path, writer, suffix=''):
+        """ Calls 'writer(temporary)' to write the file or directory 'temporary', then renames it to 'path'.
+        'suffix' is appended to the temporary name (e.g. an extension telling the image format).
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        temporary = '%s.%d.tmp%s' % (path, threading.current_thread().ident, suffix)
+        self._remove(temporary)
+        writer(temporary)
+        self._remove(path)  # 'os.rename()' does not replace existing files on Windows
+        os.rename(temporary, path)
+
+    def evict(self, keep=()):
+        """ Removes the least recently used entries, except those with a path in 'keep', until the size of the
+        cache is at most 'max_size'.
+        """
+        keep = set(os.path.realpath(path) for path in keep)
+        entries = self.entries()
+        total = sum(size for mtime, size, paths in entries)
+        for mtime, size, paths in sorted(entries):
+            if total <= self.max_size:
+                break
+            if any(os.path.realpath(path) in keep for path in paths):
+                continue
+            try:
+                os.remove(paths[0])
+            except OSError:
+                continue
+            for path in paths[1:]:
+                self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+    def _files(self, pattern):
+        """ Returns the entries made of one file of 'directory' matching 'pattern'.
+        """
+        entries = []
+        for filename in glob.glob(os.path.join(self.directory, pattern)):
+            if '.tmp' in os.path.basename(filename):
+                continue
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, [filename]))
+        return entries
+
+
+#
+# UncompressedCache
+#
+
+class UncompressedCache(LRUCache):
+    """
+  Uncompressed copies of compressed images (e.g. downloaded data), which are faster to read.
+
+  The copy of 'name' is 'directory/name' ('.gz' extension removed). The original file is kept, so that its
+  md5 sum can still be verified, and a copy older than its original is converted again.
+  Only images whose header says that they are compressed are converted (NRRD 'encoding' other than 'raw',
+  MetaImage 'CompressedData = True', '.gz' files). Other images are used as they are.
+  When the copies use more than 'max_size' bytes, the least recently used ones are removed by 'evict()'.
+  """
+
+    @staticmethod
+    def isCompressed(filename):
+        lower = filename.lower()
+        if lower.endswith('.gz'):
+            return True
+        if not lower.endswith(('.nrrd', '.nhdr', '.mha', '.mhd')):
+            return False
+        with open(filename, 'rb') as f:
+            header = f.read(4096)
+        if lower.endswith(('.nrrd', '.nhdr')):
+            encoding = re.search(r'^encoding:\s*(\S+)', header, re.M)
+            return bool(encoding) and encoding.group(1).lower() != 'raw'
+        compressed = re.search(r'^CompressedData\s*=\s*(\S+)', header, re.M)
+        return bool(compressed) and compressed.group(1).lower() == 'true'
+
+    def path(self, filename):
+        name = os.path.basename(filename)
+        if name.lower().endswith('.gz'):
+            name = name[:-3]
+        return os.path.join(self.directory, name)
+
+    def lookup(self, filename):
+        """ Returns the uncompressed copy of 'filename' if it is up to date, 'filename' otherwise.
+        """
+        copy_fn = self.path(filename)
+        try:
+            if os.path.getmtime(copy_fn) >= os.path.getmtime(filename):
+                os.utime(copy_fn, None)  # Mark as recently used
+                return copy_fn
+        except OSError:
+            pass
+        return filename
+
+    def get(self, filename):
+        """ Returns the uncompressed copy of 'filename', creating it if needed, or 'filename' if it is not compressed.
+        """
+        copy_fn = self.lookup(filename)
+        if copy_fn != filename or not self.isCompressed(filename):
+            return copy_fn
+        copy_fn = self.path(filename)
+        self.write(copy_fn, lambda temporary: sitk.WriteImage(sitk.ReadImage(filename), temporary, False),
+                   os.path.splitext(copy_fn)[1])
+        logging.info('Uncompressed copy of %s written in %s' % (filename, copy_fn))
+        return copy_fn
+
+    def entries(self):
+        return self._files('*')
+
+
+#
+# PreprocessingCache
+#
+
+class PreprocessingCache(LRUCache):
+    """
+  Persistent cache of preprocessed input images (histogram matching to the reference image and
+  Gaussian smoothing).
+
+  Preprocessed images are stored in 'directory', named after a key computed from the content of the input
+  image, the content of the reference image and the preprocessing parameters. File content hashes are
+  memoized based on file path, size and modification time. When the cache is larger than 'max_size' bytes,
+  the least recently used images are removed.
+  """
+
+    version = 1  # Change when the preprocessing implementation changes, to invalidate existing images
+
+    def __init__(self, directory, max_size=5 * 1024 ** 3):
+        LRUCache.__init__(self, directory, max_size)
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _signature(self, filename):
+        stat = os.stat(filename)
+        return os.path.realpath(filename), stat.st_size, stat.st_mtime
+
+    def rememberHash(self, filename, md5):
+        """ Records 'md5' as the hash of the current content of 'filename', e.g. once it has been verified after
+        a download, so that 'fileHash()' does not read the file again.
+        """
+        signature = self._signature(filename)
+        with self._lock:
+            self._hashes[signature] = md5
+
+    def fileHash(self, filename):
+        """ Returns the md5 of the content of 'filename'.
+        """
+        signature = self._signature(filename)
+        with self._lock:
+            if signature in self._hashes:
+                return self._hashes[signature]
+        m = hashlib.md5()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1048576), b""):
+                m.update(chunk)
+        with self._lock:
+            self._hashes[signature] = m.hexdigest()
+        return m.hexdigest()
+
+    def key(self, input_fn, reference_fn, parameters):
+        """ Returns the key identifying the preprocessing of 'input_fn' with the given reference and parameters.
+        """
+        m = hashlib.sha1()
+        m.update(str(self.version))
+        m.update(self.fileHash(input_fn))
+        if reference_fn:
+            m.update(self.fileHash(reference_fn))
+        m.update(repr(sorted(parameters.items())))
+        return m.hexdigest()
+
+    def preprocess(self, input_fn, reference_fn, histogram_matching=False, sigma=0):
+        """ Returns the file name of the preprocessed image, computing it only if it is not in the cache.
+        """
+        parameters = {'histogram_matching': bool(histogram_matching), 'sigma': float(sigma)}
+        filename = os.path.join(self.directory, self.key(input_fn, reference_fn, parameters) + '.nrrd')
+        if os.path.isfile(filename):
+            os.utime(filename, None)  # Mark as recently used
+            logging.info('Using cached preprocessed image for %s' % input_fn)
+            return filename
+        image = sitk.ReadImage(input_fn)
+        if histogram_matching:
+            image = sitk.HistogramMatching(image, sitk.Cast(sitk.ReadImage(reference_fn), image.GetPixelID()),
+                                           1024, 7, True)
+        if sigma > 0:
+            image = sitk.SmoothingRecursiveGaussian(image, sigma)
+        self.write(filename, lambda temporary: sitk.WriteImage(image, temporary), '.nrrd')
+        self.evict()
+        return filename
+
+    def entries(self):
+        return self._files('*.nrrd')
+
+
+#
+# RunCache
+#
+
+class RunCache(LRUCache):
+    """
+  Cache of complete pyLAR runs: running a configuration that was already run on the same input images
+  with the same tools reuses the outputs of the previous run instead of recomputing them.
+
+  A run is identified by a fingerprint computed from the algorithm, the configuration fields that affect
+  the results, the content of the selected input images, of the reference image and of the mask, and the
+  tools used (path, size and modification time of each executable). The outputs of each run are stored in
+  'directory/<fingerprint>/' and listed in 'directory/<fingerprint>.json', so that they remain available
+  when the result directory is cleaned or removed (e.g. by 'ResultStore'), and are stored into the new
+  result directory when they are reused. Outputs are hard-linked, so that storing a run does not duplicate
+  its images, or copied when the file system does not support hard links. A hard-linked output shares its
+  content with the cache: outputs are replaced by new runs (pyLAR's 'clean'), never modified in place.
+  When the cache is larger than 'max_size' bytes, the least recently used runs are removed.
+  """
+
+    version = 3  # Change when the fingerprint changes, to invalidate existing records
+    # Configuration fields that do not change the outputs of a run. Whether the preprocessing cache is enabled
+    # changes which tool registers the images of 'lr' (see 'LowRankImageDecompositionLogic._preprocessInputs()'),
+    # but not its size.
+    ignored = ['file_list_file_name', 'reference_im_fn', 'result_dir', 'clean', 'verbose', 'number_of_cpu',
+               'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'memory_budget', 'run_cache', 'mask_fn', 'profile']
+
+    def __init__(self, directory, fileHash, max_size=5 * 1024 ** 3):
+        LRUCache.__init__(self, directory, max_size)
+        self.fileHash = fileHash
+
+    def fingerprint(self, algo, config, im_fns, software):
+        """ Returns the fingerprint of running 'algo' with 'config' on the selected images of 'im_fns'.
+
+        Images that are not selected are not read, so they do not need to be available.
+        """
+        fields = dict((name, getattr(config, name)) for name in dir(config)
+                      if not name.startswith('_') and name not in self.ignored
+                      and not callable(getattr(config, name)) and not isinstance(getattr(config, name), type(os)))
+        if 'preprocessing_cache' in fields:
+            fields['preprocessing_cache'] = bool(fields['preprocessing_cache'])
+        tools = []
+        for name in sorted(dir(software)):
+            if name.startswith('EXE_'):
+                path = getattr(software, name)
+                if path and os.path.isfile(path):
+                    stat = os.stat(path)
+                    tools.append((name, os.path.realpath(path), stat.st_size, stat.st_mtime))
+                else:
+                    tools.append((name, None))
+        selection = getattr(config, 'selection', range(len(im_fns)))
+        reference_im_fn = getattr(config, 'reference_im_fn', None)
+        m = hashlib.sha1()
+        m.update(str(self.version))
+        m.update(algo)
+        m.update(json.dumps(fields, sort_keys=True, default=repr))
+        m.update(repr([self.fileHash(im_fns[i]) for i in selection]))
+        m.update(self.fileHash(reference_im_fn) if reference_im_fn else '')
+        mask_fn = getattr(config, 'mask_fn', None)
+        m.update(self.fileHash(mask_fn) if mask_fn else '')
+        m.update(repr(tools))
+        return m.hexdigest()
+
+    def _record(self, fingerprint):
+        return os.path.join(self.directory, fingerprint + '.json')
+
+    @staticmethod
+    def _link(source, target):
+        """ Hard-links 'source' to 'target', or copies it if the file system does not support hard links.
+        """
+        try:
+            os.link(source, target)
+        except (OSError, AttributeError):  # e.g. EXDEV, EPERM, EMLINK, or no 'os.link' on Windows with Python 2
+            shutil.copy2(source, target)
+
+    def store(self, fingerprint, result_dir):
+        """ Stores the outputs listed in 'result_dir/list_outputs.txt' in the cache and records them for
+        'fingerprint'.
+        """
+        outputs = pyLAR.readTxtIntoList(os.path.join(result_dir, 'list_outputs.txt'))
+        names = []
+        for output in outputs:
+            name = os.path.relpath(output, result_dir)
+            if name.startswith(os.pardir):
+                name = os.path.basename(output)
+            names.append(name)
+
+        def link(temporary):
+            for output, name in zip(outputs, names):
+                if not os.path.isdir(os.path.dirname(os.path.join(temporary, name))):
+                    os.makedirs(os.path.dirname(os.path.join(temporary, name)))
+                self._link(output, os.path.join(temporary, name))
+
+        def dump(temporary):
+            with open(temporary, 'w') as f:
+                json.dump({'outputs': names}, f)
+
+        # The record is removed first, so that the run is never used while its outputs are replaced
+        self._remove(self._record(fingerprint))
+        self.write(os.path.join(self.directory, fingerprint), link)
+        self.write(self._record(fingerprint), dump)
+        self.evict()
+
+    def materialize(self, fingerprint, result_dir):
+        """ Stores the outputs recorded for 'fingerprint' into 'result_dir' and writes 'list_outputs.txt'.
+
+        Returns
+        -------
+        List of the outputs in 'result_dir', or None if no complete previous run was found.
+        """
+        try:
+            with open(self._record(fingerprint), 'r') as f:
+                record = json.load(f)
+        except (IOError, ValueError):
+            return None
+        run_dir = os.path.join(self.directory, fingerprint)
+        if not all(os.path.isfile(os.path.join(run_dir, name)) for name in record['outputs']):
+            return None
+        os.utime(self._record(fingerprint), None)  # Mark as recently used
+        outputs = []
+        for name in record['outputs']:
+            target = os.path.join(result_dir, name)
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            if os.path.lexists(target):
+                os.remove(target)
+            self._link(os.path.join(run_dir, name), target)
+            outputs.append(target)
+        pyLAR.writeTxtFromList(os.path.join(result_dir, 'list_outputs.txt'), outputs)
+        return outputs
+
+    def entries(self):
+        """ Runs are listed by their record, whose modification time is updated when the run is used, and removed
+        with their outputs.
+        """
+        runs = []
+        for mtime, size, paths in self._files('*.json'):
+            run_dir = os.path.splitext(paths[0])[0]
+            for directory, directories, files in os.walk(run_dir):
+                size += sum(os.path.getsize(os.path.join(directory, name)) for name in files)
+            runs.append((mtime, size, paths + [run_dir]))
+        return runs
+
+
+#
+# ResultStore
+#
+
+class ResultStore(object):
+    """
+  Manages the result directories written in 'root' (by default, Slicer's temporary directory).
+
+  Directories that must be removed are first renamed into a trash directory located next to them, which is
+  instantaneous, and are then deleted by a background thread. Directories that cannot be renamed (mount
+  points) are emptied in place instead. Result directories (directories of 'root'
+  containing 'list_outputs.txt' or 'sweep_summary.csv') older than 'retention' seconds are removed, and the
+  least recently modified ones are removed while all of them use more than 'quota' bytes.
+  """
+
+    trash_name = '.pyLAR-trash'
+    markers = ['list_outputs.txt', 'sweep_summary.csv']
+
+    def __init__(self, root, quota=None, retention=None):
+        self.root = root
+        self.quota = quota
+        self.retention = retention
+        self._tasks = Queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+        # Remove what was left in the trash by a previous session
+        self._submit(self._purge, os.path.join(root, self.trash_name))
+
+    def discard(self, path):
+        """ Moves 'path' to the trash and deletes it in the background, or deletes its content if it is a mount point.
+        """
+        if not os.path.exists(path):
+            return
+        trash = os.path.join(os.path.dirname(os.path.abspath(path)), self.trash_name)
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+        destination = os.path.join(trash, '%s-%d-%d' % (os.path.basename(os.path.abspath(path)),
+                                                        int(time() * 1000), threading.current_thread().ident))
+        try:
+            os.rename(path, destination)
+        except OSError as e:
+            if e.errno not in (errno.EBUSY, errno.EXDEV):
+                raise
+            # 'path' is a mount point, or is not on the file system of its parent: its content is deleted in place,
+            # before returning since the directory can be written again right away
+            logging.info('%s cannot be moved to the trash (%s). Deleting it in place.' % (path, e.strerror))
+            self._purge(path)
+            return
+        self._submit(self._purge, trash)
+
+    def resultDirectories(self):
+        """ Returns the list of (path, size in bytes, modification time) of the result directories in 'root'.
+        """
+        results = []
+        if not os.path.isdir(self.root):
+            return results
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name == self.trash_name or not os.path.isdir(path):
+                continue
+            if not any(os.path.isfile(os.path.join(path, marker)) for marker in self.markers):
+                continue
+            results.append((path, self._size(path), os.path.getmtime(path)))
+        return results
+
+    def usage(self):
+        """ Returns a dictionary containing the number of result directories ('results'), the space they use
+        ('used', in bytes), and the space waiting to be deleted in the trash ('trash', in bytes).
+        """
+        results = self.resultDirectories()
+        return {'results': len(results), 'used': sum(size for path, size, mtime in results),
+                'trash': self._size(os.path.join(self.root, self.trash_name))}
+
+    def enforce(self, keep=()):
+        """ Discards the result directories that are too old or exceed the quota, except those that are in 'keep'
+        or that contain a file or directory of 'keep'.
+        """
+        keep = set(os.path.realpath(path) for path in keep if path)
+        results = sorted(self.resultDirectories(), key=lambda result: result[2])
+        total = sum(size for path, size, mtime in results)
+        now = time()
+        for path, size, mtime in results:
+            directory = os.path.realpath(path)
+            if any(kept == directory or kept.startswith(directory + os.sep) for kept in keep):
+                continue
+            too_old = self.retention is not None and now - mtime > self.retention
+            over_quota = self.quota is not None and total > self.quota
+            if too_old or over_quota:
+                logging.info('Removing old results: %s (%.1f MB)' % (path, size / 1048576.0))
+                self.discard(path)
+                total -= size
+        usage = self.usage()
+        logging.info('Results in %s: %d directories, %.1f MB' % (self.root, usage['results'], usage['used'] / 1048576.0))
+
+    def enforceAsync(self, keep=()):
+        """ Runs 'enforce()' in the background thread.
+        """
+        self._submit(self.enforce, keep)
+
+    def wait(self):
+        """ Waits until all background tasks are done.
+        """
+        self._tasks.join()
+
+    def _submit(self, f, *args):
+        with self._lock:
+            if not self._worker or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._work)
+                self._worker.daemon = True
+                self._worker.start()
+        self._tasks.put((f, args))
+
+    def _work(self):
+        while True:
+            f, args = self._tasks.get()
+            try:
+                f(*args)
+            except Exception as e:
+                logging.warning('Error while managing results: %s' % e)
+            finally:
+                self._tasks.task_done()
+
+    def _purge(self, directory):
+        if os.path.isdir(directory):
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _size(self, path):
+        total = 0
+        for directory, directories, files in os.walk(path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(directory, name))
+                except OSError:
+                    pass
+        return total
+
+
+#
+# MirrorSelector
+#
+
+class MirrorSelector(object):
+    """
+  Orders the mirrors a dataset can be downloaded from, fastest first.
+
+  A mirror is a base URL (http://, https:// or file://). The URL of a file is the mirror followed by the
+  item ID of the file, unless the mirror contains '{item}' or '{name}' placeholders, which are replaced
+  by the item ID and the file name (e.g. 'file:///data/mirror/{name}').
+  Mirrors are probed by reading the beginning of a file, which gives a first throughput estimate. The
+  estimate is then updated after each download, and a mirror that fails is moved to the end of the list.
+  """
+
+    probe_size = 65536
+
+    def __init__(self, mirrors, timeout=10):
+        self.mirrors = list(mirrors)
+        self.timeout = timeout
+        self.throughput = dict((mirror, 0.0) for mirror in self.mirrors)
+        self.failures = dict((mirror, 0) for mirror in self.mirrors)
+
+    def url(self, mirror, name, item):
+        if '{item}' in mirror or '{name}' in mirror:
+            return mirror.replace('{item}', item).replace('{name}', name)
+        return mirror + item
+
+    def probe(self, name, item):
+        """ Measures the throughput of each mirror by reading the beginning of one file.
+        """
+        import urllib2
+        if len(self.mirrors) < 2:
+            return
+        for mirror in self.mirrors:
+            start_time = time()
+            try:
+                response = urllib2.urlopen(self.url(mirror, name, item), timeout=self.timeout)
+                size = len(response.read(self.probe_size))
+                response.close()
+                self.throughput[mirror] = size / max(time() - start_time, 1e-6)
+                logging.info('Mirror %s: %.2f MB/s' % (mirror, self.throughput[mirror] / 1048576.0))
+            except Exception as e:
+                logging.info('Mirror %s not available: %s' % (mirror, e))
+                self.failed(mirror)
+
+    def ordered(self):
+        """ Returns the mirrors sorted by number of failures, then by decreasing throughput.
+        The order of the list given to the constructor is used for mirrors that are not measured.
+        """
+        return sorted(self.mirrors, key=lambda mirror: (self.failures[mirror], -self.throughput[mirror],
+                                                        self.mirrors.index(mirror)))
+
+    def succeeded(self, mirror, size, elapsed):
+        throughput = size / max(elapsed, 1e-6)
+        if self.throughput[mirror]:
+            throughput = 0.5 * self.throughput[mirror] + 0.5 * throughput
+        self.throughput[mirror] = throughput
+
+    def failed(self, mirror):
+        self.failures[mirror] += 1
+
+
+#
+# DatasetRegistry
+#
+
+class DatasetRegistry(object):
+    """
+  Index of the example datasets described by the JSON manifests stored in the 'Data' directory.
+
+  Each manifest is read and parsed only once (it is read again only if the file is modified on disk).
+  Files are kept in the order in which they appear in their manifest, so that integer selections
+  computed from the registry are stable and match the positions used by 'thread_downloadData()'
+  and 'createExampleConfigurationAndListFiles()'.
+  Every file is indexed by name, subject ID and modality. Subject IDs and modalities are parsed from
+  the file names (e.g. 'Normal078-MRA.mha' -> subject 78, modality 'MRA').
+  """
+
+    Entry = collections.namedtuple('Entry', ['manifest', 'position', 'name', 'item', 'md5', 'subject', 'modality'])
+    name_pattern = re.compile(r'^\D*?(?P<subject>\d+)(?:-(?P<modality>.+))?$')
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self._lock = threading.RLock()
+        self._manifests = {}  # manifest name -> (mtime, content)
+        self._entries = {}  # manifest name -> list of entries
+        self._by_name = {}
+        self._by_subject = {}
+        self._by_modality = {}
+        self._indexed = False
+
+    def manifestNames(self):
+        """ Returns the sorted list of manifests available in the 'Data' directory.
+        """
+        return sorted(os.path.basename(f) for f in glob.glob(os.path.join(self.data_dir, '*.json')))
+
+    def load(self, manifest):
+        """ Returns the content of a manifest, reading it from disk only if it is not already loaded.
+
+        The 'files' dictionary is an OrderedDict that preserves the order of the manifest.
+        A copy is returned so that callers cannot modify the cached content.
+        """
+        path = os.path.join(self.data_dir, manifest)
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            cached = self._manifests.get(manifest)
+            if cached is None or cached[0] != mtime:
+                with open(path, 'r') as f:
+                    content = json.load(f, object_pairs_hook=collections.OrderedDict)
+                self._manifests[manifest] = (mtime, content)
+                self._index(manifest, content)
+                cached = self._manifests[manifest]
+            return copy.deepcopy(cached[1])
+
+    def _index(self, manifest, content):
+        """ (Re)builds the index entries of one manifest.
+        """
+        for entry in self._entries.get(manifest, []):
+            self._by_name[entry.name].remove(entry)
+            if entry.subject is not None:
+                self._by_subject[entry.subject].remove(entry)
+            if entry.modality is not None:
+                self._by_modality[entry.modality].remove(entry)
+        entries = []
+        for position, (name, value) in enumerate(content.get('files', {}).items()):
+            subject, modality = self.parseName(name)
+            entry = self.Entry(manifest, position, name, value[0], value[1], subject, modality)
+            entries.append(entry)
+            self._by_name.setdefault(name, []).append(entry)
+            if subject is not None:
+                self._by_subject.setdefault(subject, []).append(entry)
+            if modality is not None:
+                self._by_modality.setdefault(modality, []).append(entry)
+        self._entries[manifest] = entries
+
+    def parseName(self, name):
+        """ Extracts subject ID and modality from a file name. Returns None for values that cannot be found.
+        """
+        match = self.name_pattern.match(os.path.splitext(os.path.basename(name))[0])
+        if not match:
+            return None, None
+        return int(match.group('subject')), match.group('modality')
+
+    def _indexAll(self):
+        with self._lock:
+            if not self._indexed:
+                for manifest in self.manifestNames():
+                    self.load(manifest)
+                self._indexed = True
+
+    def query(self, manifest=None, names=None, subjects=None, modality=None):
+        """ Returns the entries matching all the given criteria, in manifest order.
+
+        Parameters
+        ----------
+        manifest: name of a JSON file in 'Data'. If None, all manifests are searched.
+        names: list of file names.
+        subjects: list (or range) of subject IDs.
+        modality: modality name (e.g. 'T1-MPRage', 'MRA').
+        """
+        if manifest is not None:
+            self.load(manifest)
+        else:
+            self._indexAll()
+        with self._lock:
+            if names is not None:
+                candidates = [e for n in names for e in self._by_name.get(n, [])]
+            elif subjects is not None:
+                candidates = [e for s in set(subjects) for e in self._by_subject.get(s, [])]
+            elif modality is not None:
+                candidates = list(self._by_modality.get(modality, []))
+            elif manifest is not None:
+                candidates = list(self._entries[manifest])
+            else:
+                candidates = [e for m in sorted(self._entries) for e in self._entries[m]]
+        if subjects is not None:
+            subjects = set(subjects)
+        result = [e for e in candidates
+                  if (manifest is None or e.manifest == manifest)
+                  and (subjects is None or e.subject in subjects)
+                  and (modality is None or e.modality == modality)]
+        return sorted(set(result), key=lambda e: (e.manifest, e.position))
+
+    def selection(self, manifest, **kwargs):
+        """ Returns the positions in 'manifest' of the files matching the criteria given to 'query()'.
+
+        The result can directly be used as 'selection' argument of 'thread_downloadData()' and
+        'createExampleConfigurationAndListFiles()'.
+        """
+        return [e.position for e in self.query(manifest=manifest, **kwargs)]
+
+
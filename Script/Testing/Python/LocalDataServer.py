@@ -0,0 +1,91 @@
+"""
+Serves generated test data over HTTP on the local host, as a stand-in for the Midas server, so that the
+tests of LowRankImageDecomposition that download data do not need network access.
+"""
+import os
+import hashlib
+import collections
+import threading
+import logging
+
+
+class LocalDataServer(object):
+    """
+  Serves generated test data over HTTP on the local host, as a stand-in for the Midas server.
+
+  Files are served as '<url><item>' where 'url' ends with 'download?items=', like on Midas, so that
+  the dictionary returned by 'manifest' can be given to 'thread_downloadData' without network access.
+  The paths of the requests received are recorded in 'requests'.
+  """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.files = collections.OrderedDict()
+        self.requests = []
+        self.server = None
+        self.url = None
+
+    def add(self, name, content):
+        """ Adds a file to serve and returns its item ID.
+        """
+        item = str(len(self.files) + 1)
+        with open(os.path.join(self.directory, item), 'wb') as f:
+            f.write(content)
+        self.files[name] = [item, hashlib.md5(content).hexdigest()]
+        return item
+
+    def addImage(self, name, size=(8, 8, 8), value=0):
+        """ Adds a small NRRD image (unsigned char) in which all voxels are set to 'value'.
+        """
+        header = 'NRRD0004\ntype: unsigned char\ndimension: %d\nsizes: %s\nencoding: raw\n\n' \
+                 % (len(size), ' '.join(str(s) for s in size))
+        voxels = reduce(lambda x, y: x * y, size)
+        return self.add(name, header + chr(value % 256) * voxels)
+
+    def manifest(self, names=None):
+        """ Returns a dictionary with the same structure as the JSON files in the 'Data' directory.
+        """
+        files = collections.OrderedDict((name, self.files[name]) for name in (names or self.files.keys()))
+        return {'url': self.url, 'files': files}
+
+    def start(self):
+        import BaseHTTPServer
+        import SocketServer
+        import urlparse
+        server = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(self.path)
+                items = urlparse.parse_qs(urlparse.urlparse(self.path).query).get('items', [''])
+                filePath = os.path.join(server.directory, os.path.basename(items[0]))
+                if not items[0] or not os.path.isfile(filePath):
+                    self.send_error(404)
+                    return
+                with open(filePath, 'rb') as f:
+                    content = f.read()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/octet-stream')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                logging.debug('LocalDataServer: ' + format % args)
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/download?items=' % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
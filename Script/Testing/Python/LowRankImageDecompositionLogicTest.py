@@ -0,0 +1,261 @@
+"""
+Runs the tests of LowRankImageDecompositionTest that only exercise the logic, outside of Slicer.
+
+Slicer is replaced by lightweight stand-ins ('slicer.app' settings and temporary path, 'slicer.util.loadVolume',
+'qt', 'ctk', 'vtk'), and data is served by a LocalDataServer instead of Midas, so the tests do not need a
+display nor network access. The other dependencies of the module (numpy, SimpleITK, pyLAR) must be available.
+The files of the manifests that tests download are generated: for these tests, the manifests read by the module
+point to the LocalDataServer, with the checksums of the generated files.
+
+Each test runs in its own process, with its own cache and temporary directories, so that tests can run in
+parallel. The time taken by each test is reported once all the tests are done.
+
+Usage:
+  python LowRankImageDecompositionLogicTest.py [--module-dir DIR] [-j JOBS] [test_name ...]
+"""
+import os
+import sys
+import shutil
+import tempfile
+import types
+import unittest
+import logging
+import argparse
+import multiprocessing
+import traceback
+import glob
+import json
+import collections
+from time import time
+
+from LocalDataServer import LocalDataServer
+
+OFFLINE_TESTS = [
+    'test_loadJSONFile',
+    'test_createConfiguration',
+    'test_datasetRegistry',
+    'test_missingInputs',
+    'test_progressTracker',
+    'test_errorLogCursor',
+    'test_workerProfiler',
+    'test_concurrencyLimit',
+    'test_threadPlanner',
+    'test_inputValidator',
+    'test_preprocessingCache',
+    'test_uncompressedCache',
+    'test_resultStore',
+    'test_runCache',
+    'test_lowRankBasis',
+    'test_lowRankSweep',
+    'test_lowRankSweepPyLAR',
+    'test_maskedLowRankDecomposition',
+    'test_sparseImage',
+    'test_downloadDataMirrors',
+    'test_downloadDataArchive',
+    'test_downloadDataLocalServer',
+    'test_downloadData',
+    'test_lowRankImageDecomposition',
+    'test_lowRankImageDecompositionPipelined',
+]
+
+# Manifests whose files are generated and served by a LocalDataServer, for the tests that download them
+SERVED_MANIFESTS = ['TestDownloadOneImage.json', 'Bullseye.json']
+SERVED_TESTS = ['test_downloadData', 'test_lowRankImageDecomposition', 'test_lowRankImageDecompositionPipelined']
+
+
+class Settings(dict):
+    """ Stand-in for the QSettings returned by 'slicer.app.settings()'.
+    """
+
+    def value(self, key, default=None):
+        return self.get(key, default)
+
+    def setValue(self, key, value):
+        self[key] = value
+
+
+class Application(object):
+    """ Stand-in for 'slicer.app'.
+    """
+
+    def __init__(self, directory):
+        self.temporaryPath = os.path.join(directory, 'Temporary')
+        self.slicerHome = directory
+        self.extensionsInstallPath = directory
+        cache = os.path.join(directory, 'Cache')
+        os.makedirs(self.temporaryPath)
+        os.makedirs(cache)
+        self._settings = Settings({'Cache/Path': cache, 'Cache/ForceRedownload': 'false'})
+
+    def settings(self):
+        return self._settings
+
+    def processEvents(self):
+        pass
+
+
+class QTimer(object):
+    """ Stand-in for 'qt.QTimer'. Timers never fire: queues are processed explicitly by the tests.
+    """
+
+    def __init__(self, *args):
+        pass
+
+    def setInterval(self, interval):
+        pass
+
+    def connect(self, signal, slot):
+        pass
+
+    def start(self, *args):
+        pass
+
+    def stop(self):
+        pass
+
+    @staticmethod
+    def singleShot(msec, callable):
+        pass
+
+
+class Widget(object):
+    """ Stand-in for the module widget, which receives progress and end of run notifications.
+    """
+
+    def onProgress(self, progress):
+        pass
+
+    def onLogicRunStop(self):
+        pass
+
+
+class ScriptedLoadableModuleTest(unittest.TestCase):
+    """ Stand-in for 'slicer.ScriptedLoadableModule.ScriptedLoadableModuleTest'.
+    """
+
+    def delayDisplay(self, message, msec=None):
+        logging.debug(message)
+
+
+def installStandIns(directory):
+    """ Inserts the Slicer stand-ins in 'sys.modules'.
+
+    Volumes passed to 'slicer.util.loadVolume' are recorded in 'slicer.util.loadedVolumes'.
+    """
+    qt = types.ModuleType('qt')
+    qt.QTimer = QTimer
+    for name in ['QObject', 'QWidget', 'QProgressBar']:
+        setattr(qt, name, type(name, (object,), {}))
+    slicer = types.ModuleType('slicer')
+    slicer.__path__ = []
+    slicer.app = Application(directory)
+    slicer.mrmlScene = types.ModuleType('slicer.mrmlScene')
+    slicer.mrmlScene.Clear = lambda *args: None
+    slicer.util = types.ModuleType('slicer.util')
+    slicer.util.loadedVolumes = []
+    slicer.util.loadVolume = lambda filePath, *args, **kwargs: slicer.util.loadedVolumes.append(filePath) or True
+    slicer.modules = types.ModuleType('slicer.modules')
+    slicer.modules.LowRankImageDecompositionWidget = Widget()
+    scripted = types.ModuleType('slicer.ScriptedLoadableModule')
+    for name in ['ScriptedLoadableModule', 'ScriptedLoadableModuleWidget', 'ScriptedLoadableModuleLogic']:
+        setattr(scripted, name, type(name, (object,), {}))
+    scripted.ScriptedLoadableModuleTest = ScriptedLoadableModuleTest
+    scripted.__all__ = ['ScriptedLoadableModule', 'ScriptedLoadableModuleWidget',
+                        'ScriptedLoadableModuleLogic', 'ScriptedLoadableModuleTest']
+    slicer.ScriptedLoadableModule = scripted
+    sys.modules.update({'qt': qt, 'ctk': types.ModuleType('ctk'), 'vtk': types.ModuleType('vtk'),
+                        'slicer': slicer, 'slicer.util': slicer.util, 'slicer.modules': slicer.modules,
+                        'slicer.ScriptedLoadableModule': scripted})
+
+
+def serveManifests(module, directory):
+    """ Generates the files of SERVED_MANIFESTS, serves them with a LocalDataServer, and makes the dataset registry
+    of 'module' read manifests that point to this server. Returns the server, which is started.
+    """
+    server = LocalDataServer(os.path.join(directory, 'Server'))
+    data_dir = os.path.join(directory, 'Data')
+    os.makedirs(data_dir)
+    manifests = {}
+    for filename in glob.glob(os.path.join(os.path.dirname(os.path.realpath(module.__file__)), 'Data', '*.json')):
+        with open(filename, 'r') as f:
+            manifests[os.path.basename(filename)] = json.load(f, object_pairs_hook=collections.OrderedDict)
+    for name in SERVED_MANIFESTS:
+        for index, image in enumerate(manifests[name]['files'].keys()):
+            if image not in server.files:
+                server.addImage(image, size=(16, 16, 16), value=index + 1)
+    server.start()
+    for name, manifest in manifests.items():
+        if name in SERVED_MANIFESTS:
+            manifest = server.manifest(manifest['files'].keys())
+        with open(os.path.join(data_dir, name), 'w') as f:
+            json.dump(manifest, f, indent=2)
+    registry = module.DatasetRegistry
+
+    class ServedDatasetRegistry(registry):
+        def __init__(self, unused_data_dir):
+            registry.__init__(self, data_dir)
+
+    module.DatasetRegistry = ServedDatasetRegistry
+    return server
+
+
+def runTest(arguments):
+    """ Runs one test in a new directory and returns (name, status, elapsed time, error message).
+    """
+    module_dir, name = arguments
+    directory = tempfile.mkdtemp(prefix=name + '-')
+    server = None
+    try:
+        installStandIns(directory)
+        sys.path.insert(0, module_dir)
+        import LowRankImageDecomposition
+        if name in SERVED_TESTS:
+            server = serveManifests(LowRankImageDecomposition, directory)
+        test = LowRankImageDecomposition.LowRankImageDecompositionTest(name)
+        result = unittest.TestResult()
+        start_time = time()
+        test.run(result)
+        elapsed = time() - start_time
+        errors = result.errors + result.failures
+        if errors:
+            return name, 'FAIL', elapsed, errors[0][1]
+        return name, 'ok', elapsed, ''
+    except Exception:
+        return name, 'ERROR', 0.0, traceback.format_exc()
+    finally:
+        if server:
+            server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('tests', nargs='*', default=OFFLINE_TESTS, help='Tests to run (default: all offline tests)')
+    parser.add_argument('--module-dir', default=os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..'),
+                        help='Directory containing LowRankImageDecomposition.py')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of tests to run in parallel')
+    args = parser.parse_args(argv)
+    module_dir = os.path.realpath(args.module_dir)
+    start_time = time()
+    pool = multiprocessing.Pool(max(1, min(args.jobs, len(args.tests))), maxtasksperchild=1)
+    try:
+        # One test per process, so that each test imports the module with its own stand-ins
+        results = pool.map(runTest, [(module_dir, name) for name in args.tests], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time() - start_time
+    for name, status, test_time, error in results:
+        if error:
+            print '%s %s\n%s' % (status, name, error)
+    print '%-40s %-6s %s' % ('Test', 'Status', 'Time (s)')
+    for name, status, test_time, error in sorted(results, key=lambda result: -result[2]):
+        print '%-40s %-6s %.3f' % (name, status, test_time)
+    failed = [result for result in results if result[1] != 'ok']
+    print 'Ran %d tests in %.3f s (%d jobs): %d failed' % (len(results), elapsed, args.jobs, len(failed))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))